@@ -20,25 +20,770 @@
 ═══════════════════════════════════════════════════════════════════════════
 """
 
-from flask import Flask, request, jsonify, make_response, send_from_directory, redirect
+from flask import Flask, request, jsonify, make_response, send_from_directory, redirect, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from flask_sock import Sock
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, timedelta
 import os
+import sys
+import sqlite3
+import fcntl
+import atexit
 import json
 import re
 import threading
+import queue
+from collections import deque, OrderedDict
+from types import SimpleNamespace
+import socket
 import time
+import random
+import uuid
+import difflib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import pytz
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, InsertOne, IndexModel
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ConnectionFailure
 from pymongo.server_api import ServerApi
+from bson import ObjectId
 
 # تحميل متغيرات البيئة
 load_dotenv()
 
+# ═══════════════════════════════════════════════════════════════════════════
+# 🕒 الوقت - كل التواريخ aware بتوقيت المطعم وتُخزن كـ BSON Date
+# ═══════════════════════════════════════════════════════════════════════════
+
+LOCAL_TZ = pytz.timezone('Asia/Jerusalem')
+
+def now_local():
+    """الوقت الحالي بتوقيت المطعم (aware)"""
+    return datetime.now(LOCAL_TZ)
+
+def local_midnight(days_ago=0):
+    """بداية اليوم بتوقيت المطعم - localize حتى يكون فرق التوقيت الصيفي صحيحاً"""
+    day = now_local().date() - timedelta(days=days_ago)
+    return LOCAL_TZ.localize(datetime(day.year, day.month, day.day))
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🗄️ تخزين محلي (SQLite WAL) - بديل MongoDB لمطعم واحد بدون إنترنت
+# STORAGE_BACKEND=sqlite
+# ═══════════════════════════════════════════════════════════════════════════
+# كل collection جدول (_id, doc JSON) + عمود "@field" مفهرس لكل حقل في INDEX_SPECS. SQLiteCollection تنفذ الجزء الذي يستخدمه هذا الملف
+# من واجهة pymongo (find / update / bulk_write / aggregate للإحصائيات ...)، فيبقى باقي الكود كما هو.
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongo')   # mongo / sqlite
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taboon.db'))
+LEGACY_CUSTOMERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'customers_data.json')
+SQLITE_TTL_SWEEP_SECONDS = 60
+
+# عمليات bulk_write للـ backendين: نفس InsertOne / UpdateOne من pymongo (تعمل مع MongoDB كما هي)،
+# مع حفظ محتواها كخصائص عامة تقرأها SQLiteCollection.bulk_write
+class InsertOp(InsertOne):
+    def __init__(self, document):
+        super().__init__(document)
+        self.document = document
+
+class UpdateOp(UpdateOne):
+    def __init__(self, filter, update, upsert=False):
+        super().__init__(filter, update, upsert=upsert)
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+
+def _bson_default(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = pytz.utc.localize(value)    # مثل pymongo: naive = UTC
+        return {'$date': value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+def _bson_hook(obj):
+    if len(obj) == 1:
+        if '$date' in obj:
+            return datetime.fromisoformat(obj['$date']).astimezone(LOCAL_TZ)
+        if '$oid' in obj:
+            return ObjectId(obj['$oid'])
+    return obj
+
+def _encode(value):
+    return json.dumps(value, default=_bson_default, ensure_ascii=False)
+
+def _decode(text):
+    return json.loads(text, object_hook=_bson_hook)
+
+def _get_field(doc, path):
+    """(موجود؟، القيمة) لحقل قد يكون بنقاط a.b"""
+    for key in path.split('.'):
+        if not isinstance(doc, dict) or key not in doc:
+            return False, None
+        doc = doc[key]
+    return True, doc
+
+def _set_field(doc, path, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        doc = doc.setdefault(key, {})
+    doc[keys[-1]] = value
+
+# ترتيب الأنواع في MongoDB عند المقارنة والترتيب
+def _type_rank(value):
+    if value is None:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, list):
+        return 5
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+def _comparable(value):
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return pytz.utc.localize(value)
+    return value
+
+def _sort_key(value):
+    return (_type_rank(value), _comparable(value) if _type_rank(value) not in (1, 4, 5) else 0)
+
+def _compare(a, op, b):
+    # أنواع مختلفة لا تتطابق (نص لا يقارن مع تاريخ) - مثل MongoDB
+    if _type_rank(a) != _type_rank(b):
+        return False
+    a, b = _comparable(a), _comparable(b)
+    return {'$gt': a > b, '$gte': a >= b, '$lt': a < b, '$lte': a <= b}[op]
+
+def _match_condition(exists, value, condition):
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        for op, arg in condition.items():
+            values = value if isinstance(value, list) else [value]
+            if op == '$exists':
+                ok = exists == bool(arg)
+            elif op == '$eq':
+                ok = exists and (value == arg or arg in values)
+            elif op == '$ne':
+                ok = not (exists and (value == arg or arg in values))
+            elif op == '$in':
+                ok = exists and any(v in arg for v in values)
+            elif op == '$nin':
+                ok = not (exists and any(v in arg for v in values))
+            elif op in ('$gt', '$gte', '$lt', '$lte'):
+                ok = exists and any(_compare(v, op, arg) for v in values)
+            elif op == '$not':
+                ok = not _match_condition(exists, value, arg)
+            elif op == '$type':
+                names = {'string': str, 'date': datetime, 'int': int, 'double': float, 'object': dict, 'array': list}
+                ok = exists and isinstance(value, names[arg])
+            else:
+                raise NotImplementedError(f"SQLite storage: unsupported operator {op}")
+            if not ok:
+                return False
+        return True
+    if not exists:
+        return condition is None
+    return value == condition or (isinstance(value, list) and condition in value)
+
+def _matches(doc, query):
+    for key, condition in (query or {}).items():
+        if key == '$or':
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$and':
+            if not all(_matches(doc, sub) for sub in condition):
+                return False
+        else:
+            exists, value = _get_field(doc, key)
+            if not _match_condition(exists, value, condition):
+                return False
+    return True
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    include = {k.split('.')[0] for k, v in projection.items() if v and k != '_id'}
+    if include:
+        result = {k: doc[k] for k in include if k in doc}
+        if projection.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+def _apply_update(doc, update, inserting=False):
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in fields.items():
+            exists, current = _get_field(doc, path)
+            if op in ('$set', '$setOnInsert'):
+                _set_field(doc, path, arg)
+            elif op == '$inc':
+                _set_field(doc, path, (current if exists else 0) + arg)
+            elif op == '$max':
+                if not exists or _compare(arg, '$gt', current):
+                    _set_field(doc, path, arg)
+            elif op == '$push':
+                _set_field(doc, path, (current if exists else []) + [arg])
+            elif op == '$unset':
+                if exists:
+                    parent = _get_field(doc, path.rsplit('.', 1)[0])[1] if '.' in path else doc
+                    parent.pop(path.rsplit('.', 1)[-1], None)
+            else:
+                raise NotImplementedError(f"SQLite storage: unsupported update {op}")
+
+def _eval_expr(doc, expr):
+    if isinstance(expr, str) and expr.startswith('$'):
+        return _get_field(doc, expr[1:])[1]
+    if isinstance(expr, dict) and len(expr) == 1:
+        op, args = next(iter(expr.items()))
+        if op == '$cond':
+            return _eval_expr(doc, args[1] if _eval_expr(doc, args[0]) else args[2])
+        if op == '$eq':
+            return _eval_expr(doc, args[0]) == _eval_expr(doc, args[1])
+    return expr
+
+def _run_pipeline(docs, pipeline):
+    """$match / $sort / $limit / $group ($sum) / $facet - ما تحتاجه الإحصائيات"""
+    for stage in pipeline:
+        op, spec = next(iter(stage.items()))
+        if op == '$match':
+            docs = [d for d in docs if _matches(d, spec)]
+        elif op == '$sort':
+            for field, direction in reversed(list(spec.items())):
+                docs.sort(key=lambda d: _sort_key(_get_field(d, field)[1]), reverse=direction < 0)
+        elif op == '$limit':
+            docs = docs[:spec]
+        elif op == '$facet':
+            docs = [{name: _run_pipeline(list(docs), sub) for name, sub in spec.items()}]
+        elif op == '$group':
+            groups = {}
+            for d in docs:
+                key = _eval_expr(d, spec['_id'])
+                group = groups.setdefault(_encode(key), {'_id': key})
+                for field, acc in spec.items():
+                    if field != '_id':
+                        value = _eval_expr(d, acc['$sum'])
+                        group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) else 0)
+            docs = list(groups.values())
+        else:
+            raise NotImplementedError(f"SQLite storage: unsupported stage {op}")
+    return docs
+
+def _pipeline_fields(node, fields):
+    """الحقول (المستوى الأول) التي يقرأها pipeline - حتى لا نفك JSON الوثيقة كاملة"""
+    if isinstance(node, str) and node.startswith('$'):
+        fields.add(node[1:].split('.')[0])
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            if not key.startswith('$'):
+                fields.add(key.split('.')[0])
+            _pipeline_fields(value, fields)
+    elif isinstance(node, list):
+        for item in node:
+            _pipeline_fields(item, fields)
+
+# الحقول المفهرسة أعمدة حقيقية "@field" بقيمة تحفظ ترتيب MongoDB بين الأنواع:
+# أرقام < نصوص < BLOB (ObjectId / bool / تاريخ ببادئة رتبة النوع). قائمة أو وثيقة داخل حقل
+# مفهرس تُخزن NULL، فالشروط المترجمة لـ SQL تعاملها كأنها غير موجودة.
+def _column_value(value):
+    if isinstance(value, bool):
+        return bytes([8, value])
+    if isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, ObjectId):
+        return bytes([7]) + value.binary
+    if isinstance(value, datetime):
+        utc = _comparable(value).astimezone(pytz.utc).replace(tzinfo=None)
+        return bytes([9]) + utc.isoformat(timespec='microseconds').encode()
+    return None
+
+def _column_python(value):
+    """عكس _column_value - لمفاتيح GROUP BY"""
+    if not isinstance(value, bytes):
+        return value
+    if value[0] == 8:
+        return bool(value[1])
+    if value[0] == 7:
+        return ObjectId(value[1:])
+    return pytz.utc.localize(datetime.fromisoformat(value[1:].decode())).astimezone(LOCAL_TZ)
+
+def _column_bracket(value):
+    """حدود نوع القيمة داخل العمود (أدنى شامل، أعلى غير شامل) - المقارنة لا تعبر لنوع آخر"""
+    if isinstance(value, (int, float)):
+        return None, ''
+    if isinstance(value, str):
+        return '', b''
+    return value[:1], bytes([value[0] + 1])
+
+def _column_name(field):
+    return '"@' + field.replace('"', '""') + '"'
+
+_SQL_COMPARE = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<=', '$eq': '='}
+
+class SQLiteCursor:
+    def __init__(self, fetch, projection=None):
+        self._fetch = fetch
+        self._projection = projection
+        self._sort = []
+        self._limit = 0
+
+    def sort(self, key, direction=1):
+        self._sort = key if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def __iter__(self):
+        docs = self._fetch(self._sort, self._limit)
+        for field, direction in reversed(self._sort):
+            docs.sort(key=lambda d: _sort_key(_get_field(d, field)[1]), reverse=direction < 0)
+        if self._limit:
+            docs = docs[:self._limit]
+        return iter([_project(d, self._projection) for d in docs])
+
+class SQLiteStore:
+    """ملف SQLite واحد بوضع WAL - اتصال واحد لكل worker، والكتابات في transactions قصيرة"""
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')   # في WAL: آمن عند انهيار التطبيق، وسريع
+        self.lock = threading.RLock()
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = SQLiteCollection(self, name)
+        return self._collections[name]
+
+    def data_version(self):
+        """يتغير فقط عندما يكتب اتصال آخر (worker آخر) في الملف"""
+        with self.lock:
+            return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def transaction(self):
+        store = self
+
+        class _Txn:
+            def __enter__(self):
+                store.lock.acquire()
+                store.conn.execute('BEGIN IMMEDIATE')   # قفل كتابة بين الـ workers أيضاً
+                return store.conn
+
+            def __exit__(self, exc_type, exc, tb):
+                try:
+                    store.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+                finally:
+                    store.lock.release()
+        return _Txn()
+
+class SQLiteCollection:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.table = f'"{name}"'
+        self.columns = []           # الحقول المفهرسة (أعمدة "@field")
+        self._schema_version = None
+        self._ttl = None            # (field, seconds) من فهرس expireAfterSeconds
+        self._swept_at = 0
+        with store.transaction() as conn:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (_id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+            # _id كعمود أيضاً: مفتاح الجدول نص JSON لا يرتب الأرقام (sort('_id') و $gt cursor)
+            self._add_columns(conn, ['_id'])
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}._id_" ON {self.table} ({_column_name("_id")})')
+
+    # --- الأعمدة المفهرسة ---
+    def _sync_schema(self, conn):
+        """أعمدة أضافها worker آخر (create_indexes) - قبل كل كتابة حتى لا يبقى عمود فارغاً"""
+        version = conn.execute('PRAGMA schema_version').fetchone()[0]
+        if version != self._schema_version:
+            self.columns = [row[1][1:] for row in conn.execute(f'PRAGMA table_info({self.table})')
+                            if row[1].startswith('@')]
+            self._schema_version = version
+
+    def _add_columns(self, conn, fields):
+        self._sync_schema(conn)
+        missing = [f for f in dict.fromkeys(fields) if f not in self.columns]
+        if not missing:
+            return
+        for field in missing:
+            conn.execute(f'ALTER TABLE {self.table} ADD COLUMN {_column_name(field)}')
+        # تعبئة العمود الجديد للوثائق الموجودة
+        assignments = ', '.join(f'{_column_name(f)} = ?' for f in missing)
+        rows = conn.execute(f'SELECT _id, doc FROM {self.table}').fetchall()
+        conn.executemany(
+            f'UPDATE {self.table} SET {assignments} WHERE _id = ?',
+            [[_column_value(_get_field(_decode(doc), f)[1]) for f in missing] + [key] for key, doc in rows]
+        )
+        self._sync_schema(conn)
+
+    def _row(self, doc, text=None):
+        return [text or _encode(doc)] + [_column_value(_get_field(doc, f)[1]) for f in self.columns]
+
+    # --- قراءة ---
+    def _condition_sql(self, field, condition):
+        """شرط حقل واحد كـ (SQL، القيم) إذا كان الحقل عموداً والشرط يُترجم بدقة - وإلا None"""
+        if field not in self.columns:
+            return None
+        column = _column_name(field)
+        if not (isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition)):
+            condition = {'$eq': condition}
+        clauses, params = [], []
+        for op, arg in condition.items():
+            if op in _SQL_COMPARE:
+                value = _column_value(arg)
+                if value is None:
+                    return None
+                clauses.append(f'{column} {_SQL_COMPARE[op]} ?')
+                params.append(value)
+                if op != '$eq':
+                    low, high = _column_bracket(value)
+                    if low is not None:
+                        clauses.append(f'{column} >= ?')
+                        params.append(low)
+                    if high is not None:
+                        clauses.append(f'{column} < ?')
+                        params.append(high)
+            elif op == '$in':
+                values = [_column_value(v) for v in arg]
+                if any(v is None for v in values):
+                    return None
+                clauses.append(f'{column} IN ({",".join("?" * len(values))})' if values else '0')
+                params.extend(values)
+            elif op == '$not':
+                inner = self._condition_sql(field, arg)
+                if inner is None:
+                    return None
+                # مثل MongoDB: $not يطابق الحقل غير الموجود أيضاً
+                clauses.append(f'({column} IS NULL OR NOT ({inner[0]}))')
+                params.extend(inner[1])
+            else:
+                return None
+        return ' AND '.join(clauses), params
+
+    def _where(self, query):
+        """(WHERE، القيم، exact) - exact=False إذا بقي شرط لا يُترجم ويُفحص في بايثون فقط"""
+        clauses, params, exact = [], [], True
+        for key, condition in query.items():
+            if key == '_id' and not isinstance(condition, dict):
+                clauses.append('_id = ?')
+                params.append(_encode(condition))
+                continue
+            translated = self._condition_sql(key, condition)
+            if translated is None:
+                exact = False
+            else:
+                clauses.append(translated[0])
+                params.extend(translated[1])
+        return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), params, exact
+
+    def _load(self, conn, query, sort=None, limit=0, fields=None):
+        """
+        الوثائق المطابقة - الشروط والترتيب والحد على الأعمدة المفهرسة تنزل لـ SQL،
+        وما لا يُترجم يُفحص في بايثون. fields: فك حقول محددة فقط بدل الوثيقة كاملة.
+        """
+        query = query or {}
+        where, params, exact = self._where(query)
+        sql = where
+        if sort and all(field in self.columns for field, _ in sort):
+            sql += ' ORDER BY ' + ', '.join(
+                f'{_column_name(field)} {"DESC" if direction < 0 else "ASC"}' for field, direction in sort)
+            sort = None
+        # الحد في SQL فقط إذا كان الشرط والترتيب كلاهما فيه
+        if limit and exact and not sort:
+            sql += f' LIMIT {int(limit)}'
+        if fields is None:
+            select, decode = 'doc', _decode
+        else:
+            # json_extract بأكثر من مسار يرجع مصفوفة JSON بالقيم (true/false تبقى، الناقص null) - من SQLite 3.9،
+            # بدل doc -> ? الذي يحتاج 3.38. بأقل من مسارين يرجع القيمة نفسها، فنكمل بـ _id (zip يتجاهله).
+            paths = ['$."' + f.replace('"', '\\"') + '"' for f in fields]
+            paths += ['$."_id"'] * (2 - len(paths))
+            select = f"json_extract(doc, {', '.join('?' * len(paths))})"
+            params = paths + params
+            decode = lambda text: {f: v for f, v in zip(fields, _decode(text)) if v is not None}
+        rows = conn.execute(f'SELECT {select} FROM {self.table}{sql}', params).fetchall()
+        docs = (decode(row[0]) for row in rows)
+        return [d for d in docs if _matches(d, query)]
+
+    def find(self, filter=None, projection=None):
+        def fetch(sort, limit):
+            with self.store.lock:
+                return self._load(self.store.conn, filter, sort, limit)
+        return SQLiteCursor(fetch, projection)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        cursor = self.find(filter, projection)
+        if sort:
+            cursor.sort(sort)
+        return next(iter(cursor.limit(1)), None)
+
+    def count_documents(self, filter):
+        with self.store.lock:
+            where, params, exact = self._where(filter or {})
+            if exact:
+                return self.store.conn.execute(f'SELECT COUNT(*) FROM {self.table}{where}', params).fetchone()[0]
+            return len(self._load(self.store.conn, filter))
+
+    def estimated_document_count(self):
+        with self.store.lock:
+            return self.store.conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def aggregate(self, pipeline):
+        with self.store.lock:
+            # قراءة واحدة متسقة حتى لو انقسم الـ pipeline لعدة استعلامات
+            self.store.conn.execute('BEGIN')
+            try:
+                return iter(self._aggregate(self.store.conn, pipeline))
+            finally:
+                self.store.conn.execute('COMMIT')
+
+    def _aggregate(self, conn, pipeline):
+        if pipeline and '$facet' in pipeline[0]:
+            # $facet أولاً: كل فرع استعلام مستقل بحقوله و$match الخاصة به
+            facets = {name: self._aggregate(conn, sub) for name, sub in pipeline[0]['$facet'].items()}
+            return _run_pipeline([facets], pipeline[1:])
+        groups = self._count_groups(conn, pipeline)
+        if groups is not None:
+            return groups
+        fields = set()
+        _pipeline_fields(pipeline, fields)
+        # $match الأولى تنزل لـ SQL مثل find
+        first = pipeline[0].get('$match') if pipeline else None
+        return _run_pipeline(self._load(conn, first, fields=sorted(fields)), pipeline)
+
+    def _count_groups(self, conn, pipeline):
+        """[$match] + [$sort] + $group على عمود بعدّ فقط ($sum: 1) - GROUP BY في SQL بدل فك كل وثيقة؛ وإلا None"""
+        match, rest = (pipeline[0]['$match'], pipeline[1:]) if pipeline and '$match' in pipeline[0] else ({}, pipeline)
+        if rest and '$sort' in rest[0]:
+            rest = rest[1:]   # الترتيب لا يغير نتيجة الـ group (في MongoDB هو ما يختار الفهرس)
+        if len(rest) != 1 or '$group' not in rest[0]:
+            return None
+        spec = rest[0]['$group']
+        counts = [field for field in spec if field != '_id']
+        if any(spec[field] != {'$sum': 1} for field in counts):
+            return None
+        key = spec['_id']
+        if key is None:
+            column = 'NULL'
+        elif isinstance(key, str) and key.startswith('$') and key[1:] in self.columns:
+            column = _column_name(key[1:])
+        else:
+            return None
+        where, params, exact = self._where(match)
+        if not exact:
+            return None
+        rows = conn.execute(f'SELECT {column}, COUNT(*) FROM {self.table}{where} GROUP BY 1', params)
+        return [{'_id': _column_python(value), **{field: n for field in counts}} for value, n in rows]
+
+    def watch(self, *args, **kwargs):
+        # لا يوجد change stream - OrderCache والـ backplane يرجعون للقراءة الدورية
+        raise NotImplementedError("SQLite storage has no change streams")
+
+    # --- كتابة ---
+    def _write(self, conn, doc, text=None):
+        assignments = ', '.join(['doc = ?'] + [f'{_column_name(f)} = ?' for f in self.columns])
+        try:
+            conn.execute(f'UPDATE {self.table} SET {assignments} WHERE _id = ?', self._row(doc, text) + [_encode(doc['_id'])])
+        except sqlite3.IntegrityError:
+            raise DuplicateKeyError(f"E11000 duplicate key {self.name} {doc['_id']}", 11000)
+
+    def _insert(self, conn, doc):
+        doc.setdefault('_id', ObjectId())
+        columns = ', '.join(['_id', 'doc'] + [_column_name(f) for f in self.columns])
+        try:
+            conn.execute(f'INSERT INTO {self.table} ({columns}) VALUES ({",".join("?" * (len(self.columns) + 2))})',
+                         [_encode(doc['_id'])] + self._row(doc))
+        except sqlite3.IntegrityError:
+            raise DuplicateKeyError(f"E11000 duplicate key {self.name} _id {doc['_id']}", 11000)
+
+    def _upsert_doc(self, query, update):
+        doc = {k: v for k, v in query.items() if not k.startswith('$') and not isinstance(v, dict)}
+        _apply_update(doc, update, inserting=True)
+        return doc
+
+    def insert_one(self, doc):
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            self._insert(conn, doc)
+        self._sweep()
+        return SimpleNamespace(inserted_id=doc['_id'])
+
+    def insert_many(self, docs, ordered=True):
+        errors, inserted = [], []
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            for index, doc in enumerate(docs):
+                try:
+                    self._insert(conn, doc)
+                    inserted.append(doc['_id'])
+                except DuplicateKeyError as e:
+                    errors.append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        self._sweep()
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted)})
+        return SimpleNamespace(inserted_ids=inserted)
+
+    def _update(self, conn, filter, update, upsert=False, many=False):
+        """يرجع (الوثائق المطابقة بعد التعديل، عدد المعدّل فعلاً، الوثيقة المضافة بـ upsert)"""
+        docs = self._load(conn, filter, limit=0 if many else 1)
+        if not many:
+            docs = docs[:1]
+        modified = 0
+        for doc in docs:
+            before = _encode(doc)
+            _apply_update(doc, update)
+            after = _encode(doc)
+            if after != before:
+                self._write(conn, doc, after)
+                modified += 1
+        upserted = None
+        if not docs and upsert:
+            doc = self._upsert_doc(filter, update)
+            self._insert(conn, doc)
+            upserted = doc
+        return docs, modified, upserted
+
+    def update_one(self, filter, update, upsert=False):
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            docs, modified, upserted = self._update(conn, filter, update, upsert)
+        self._sweep()
+        return SimpleNamespace(matched_count=len(docs), modified_count=modified,
+                               upserted_id=upserted['_id'] if upserted else None)
+
+    def update_many(self, filter, update, upsert=False):
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            docs, modified, upserted = self._update(conn, filter, update, upsert, many=True)
+        self._sweep()
+        return SimpleNamespace(matched_count=len(docs), modified_count=modified,
+                               upserted_id=upserted['_id'] if upserted else None)
+
+    def find_one_and_update(self, filter, update, upsert=False, return_document=ReturnDocument.BEFORE, projection=None):
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            before = [dict(d) for d in self._load(conn, filter, limit=1)[:1]]
+            docs, _, upserted = self._update(conn, filter, update, upsert)
+        self._sweep()
+        if return_document == ReturnDocument.AFTER:
+            result = docs[0] if docs else upserted
+        else:
+            result = before[0] if before else None
+        return _project(result, projection) if result is not None else None
+
+    def delete_one(self, filter):
+        return self._delete(filter, many=False)
+
+    def delete_many(self, filter):
+        return self._delete(filter, many=True)
+
+    def _delete(self, filter, many):
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            docs = self._load(conn, filter, limit=0 if many else 1)
+            if not many:
+                docs = docs[:1]
+            conn.executemany(f'DELETE FROM {self.table} WHERE _id = ?', [(_encode(d['_id']),) for d in docs])
+        return SimpleNamespace(deleted_count=len(docs))
+
+    def bulk_write(self, requests, ordered=True):
+        """كل العمليات في transaction واحدة، والعدادات الحقيقية مثل BulkWriteResult"""
+        counts = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nUpserted': 0}
+        errors, upserted_ids = [], {}
+        with self.store.transaction() as conn:
+            self._sync_schema(conn)
+            for index, op in enumerate(requests):
+                try:
+                    if isinstance(op, InsertOp):
+                        self._insert(conn, op.document)
+                        counts['nInserted'] += 1
+                    elif isinstance(op, UpdateOp):
+                        docs, modified, upserted = self._update(conn, op.filter, op.update, op.upsert)
+                        counts['nMatched'] += len(docs)
+                        counts['nModified'] += modified
+                        if upserted is not None:
+                            counts['nUpserted'] += 1
+                            upserted_ids[index] = upserted['_id']
+                    else:
+                        raise NotImplementedError(f"SQLite storage: unsupported bulk op {type(op).__name__}")
+                except DuplicateKeyError as e:
+                    errors.append({'index': index, 'code': 11000, 'errmsg': str(e)})
+                    if ordered:
+                        break
+        self._sweep()
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, **counts,
+                                  'upserted': [{'index': i, '_id': v} for i, v in upserted_ids.items()]})
+        return SimpleNamespace(inserted_count=counts['nInserted'], matched_count=counts['nMatched'],
+                               modified_count=counts['nModified'], upserted_count=counts['nUpserted'],
+                               upserted_ids=upserted_ids)
+
+    # --- فهارس ---
+    def create_indexes(self, models):
+        """كل فهرس يصبح أعمدة "@field" وفهرس SQLite عليها؛ expireAfterSeconds يُنفذ بـ _sweep"""
+        names = []
+        with self.store.transaction() as conn:
+            for model in models:
+                spec = model.document
+                keys = list(spec['key'].items())
+                self._add_columns(conn, [field for field, _ in keys])
+                columns = ', '.join(f'{_column_name(f)} {"DESC" if d == -1 else "ASC"}' for f, d in keys)
+                conn.execute(f'CREATE {"UNIQUE " if spec.get("unique") else ""}INDEX IF NOT EXISTS '
+                             f'"{self.name}.{spec["name"]}" ON {self.table} ({columns})')
+                if 'expireAfterSeconds' in spec:
+                    self._ttl = (keys[0][0], spec['expireAfterSeconds'])
+                names.append(spec['name'])
+        return names
+
+    def create_index(self, keys, **kwargs):
+        return self.create_indexes([IndexModel(keys, **kwargs)])[0]
+
+    def _sweep(self):
+        """بديل فهرس TTL: يحذف المنتهي مرة كل دقيقة على الأكثر بعد أي كتابة (insert/update/bulk_write)"""
+        if self._ttl is None or time.monotonic() - self._swept_at < SQLITE_TTL_SWEEP_SECONDS:
+            return
+        self._swept_at = time.monotonic()
+        field, seconds = self._ttl
+        self.delete_many({field: {'$lt': now_local() - timedelta(seconds=seconds)}})
+
+def import_legacy_customers(collection, path=LEGACY_CUSTOMERS_FILE):
+    """أول تشغيل على SQLite: نستورد customers_data.json (المخزن القديم بالملفات)"""
+    if collection.estimated_document_count() or not os.path.exists(path):
+        return
+    with open(path, encoding='utf-8') as f:
+        customers = json.load(f)
+    for fingerprint, data in customers.items():
+        doc = {**data, '_id': fingerprint}
+        if isinstance(doc.get('lastVisit'), str):
+            try:
+                doc['lastVisit'] = datetime.fromisoformat(doc['lastVisit']).astimezone(LOCAL_TZ)
+            except ValueError:
+                pass
+        collection.insert_one(doc)
+    print(f"📥 Imported {len(customers)} customers from {os.path.basename(path)}")
+
 # ═══════════════════════════════════════════════════════════════════════════
 # 💾 قاعدة بيانات MongoDB - التخزين الدائم
 # ═══════════════════════════════════════════════════════════════════════════
@@ -47,64 +792,384 @@ MONGODB_URL = os.getenv('MONGODB_URL') or "mongodb+srv://tech40210_db_user:AOnqm
 mongo_client = None
 db_customers = None
 db_orders = None
+db_counters = None
+db_notifications = None
+db_order_events = None
+db_ready_notifications = None
+db_rollups = None
+db_archive = None
+db_locks = None
 
-if MONGODB_URL:
-    try:
-        # ✅ إضافة خيارات TLS لضمان الاتصال في بيئات مختلفة
-        # tls=True: استخدام التشفير
-        # tlsAllowInvalidCertificates=True: قبول الشهادات غير الموثوقة (شائع في البيئات التجريبية)
-        mongo_client = MongoClient(
-            MONGODB_URL, 
-            server_api=ServerApi('1'),
-            tls=True,
-            tlsAllowInvalidCertificates=True,
-            serverSelectionTimeoutMS=5000  # مهلة 5 ثواني
-        )
-        
-        # محاولة الاتصال (Ping)
-        mongo_client.admin.command('ping')
-        print("✅ Pinged your deployment. You successfully connected to MongoDB!")
+MONGO_RETRY_SECONDS = 30
+MONGO_CONNECT_HOOKS = []     # تُستدعى بعد اتصال متأخر (فهارس، إعادة تحميل الكاش...)
+_mongo_lock = threading.Lock()
+_mongo_retry_at = 0
+_mongo_down = False          # انقطاع بعد الاتصال: الطلبات تذهب للـ journal مباشرة حتى ينجح ping من الـ watchdog
+
+def connect_mongo():
+    """
+    يتصل بـ MongoDB إذا لم يكن متصلاً - عند التشغيل ثم عند الحاجة (مرة كل MONGO_RETRY_SECONDS على الأكثر).
+    يرجع True إذا كان الاتصال قائماً.
+    """
+    global mongo_client, database, db_customers, db_orders, db_counters, db_notifications
+    global db_order_events, db_ready_notifications, db_rollups, db_archive, db_locks, _mongo_retry_at
+    if db_orders is not None:
+        return True
+    if STORAGE_BACKEND != 'mongo' or not MONGODB_URL:
+        return False
+    with _mongo_lock:
+        if db_orders is not None:
+            return True
+        if time.monotonic() < _mongo_retry_at:
+            return False
+        try:
+            # ✅ إضافة خيارات TLS لضمان الاتصال في بيئات مختلفة
+            # tls=True: استخدام التشفير
+            # tlsAllowInvalidCertificates=True: قبول الشهادات غير الموثوقة (شائع في البيئات التجريبية)
+            client = MongoClient(
+                MONGODB_URL, 
+                server_api=ServerApi('1'),
+                tls=True,
+                tlsAllowInvalidCertificates=True,
+                serverSelectionTimeoutMS=5000,  # مهلة 5 ثواني
+                tz_aware=True,                  # التواريخ ترجع aware بتوقيت المطعم
+                tzinfo=LOCAL_TZ
+            )
+            
+            # محاولة الاتصال (Ping)
+            client.admin.command('ping')
+            print("✅ Pinged your deployment. You successfully connected to MongoDB!")
+        except Exception as e:
+            print(f"❌ MongoDB Connection Failed: {e}")
+            # سنحاول الاتصال مرة أخرى لاحقاً عند الحاجة
+            _mongo_retry_at = time.monotonic() + MONGO_RETRY_SECONDS
+            return False
         
         # Access database and collections
+        mongo_client = client
         database = mongo_client['king_of_taboon']
         db_customers = database['customers']
-        db_orders = database['orders']
+        db_counters = database['counters']
+        db_notifications = database['notifications']
+        db_order_events = database['order_events']
+        db_ready_notifications = database['ready_notifications']
+        db_rollups = database['order_rollups']
+        db_archive = database['orders_archive']
+        db_locks = database['locks']
+        db_orders = database['orders']     # آخر واحد: باقي الكود يعتبر db_orders علامة الاتصال
         print("✅ MongoDB Collections initialized")
-        
-    except Exception as e:
-        print(f"❌ MongoDB Connection Failed: {e}")
-        # سنحاول الاتصال مرة أخرى لاحقاً عند الحاجة
+    for hook in MONGO_CONNECT_HOOKS:
+        try:
+            hook()
+        except Exception as e:
+            print(f"Error after MongoDB connect: {e}")
+    return True
+
+def mark_mongo_down(error):
+    """عملية فشلت بانقطاع - الطلبات التالية لا تنتظر مهلة الاتصال (5 ثواني) مرة أخرى"""
+    global _mongo_down
+    if not _mongo_down:
+        print(f"⚠️ MongoDB unreachable ({error}) - new orders go to the local journal")
+    _mongo_down = True
+
+def mongo_reachable():
+    """للـ watchdog: اتصال أول أو ping بعد انقطاع - يرجع True ويعيد المسار العادي إذا رجع MongoDB"""
+    global _mongo_down
+    if not connect_mongo():
+        return False
+    if _mongo_down:
+        try:
+            mongo_client.admin.command('ping')
+        except Exception:
+            return False
+        _mongo_down = False
+        print("✅ MongoDB reachable again")
+    return True
+
+if STORAGE_BACKEND == 'sqlite':
+    database = SQLiteStore()
+    db_customers = database['customers']
+    db_orders = database['orders']
+    db_counters = database['counters']
+    db_notifications = database['notifications']
+    db_order_events = database['order_events']
+    db_ready_notifications = database['ready_notifications']
+    db_rollups = database['order_rollups']
+    db_archive = database['orders_archive']
+    db_locks = database['locks']
+    import_legacy_customers(db_customers)
+    print(f"✅ Local SQLite storage (WAL): {database.path}")
+elif MONGODB_URL:
+    connect_mongo()
 else:
     print("⚠️ No MONGODB_URL provided")
 
+# ═══════════════════════════════════════════════════════════════════════════
+# ⏱️ كتابة مؤجلة (Write-Behind) - كتابات ثانوية بدفعات bulk_write خارج مسار الرد
+# ═══════════════════════════════════════════════════════════════════════════
+
+WRITE_BEHIND_BATCH = int(os.getenv('WRITE_BEHIND_BATCH', 200))
+WRITE_BEHIND_INTERVAL = float(os.getenv('WRITE_BEHIND_INTERVAL', 0.5))
+WRITE_BEHIND_MAX_PENDING = 10000
+WRITE_BEHIND_RETRIES = 3
+# حدث ضائع يجعل شاشات الـ delta-sync تتخطى التغيير للأبد - هذه لا تُسقط، تُعاد بالترتيب حتى تنجح
+WRITE_BEHIND_NEVER_DROP = ('order_events',)
+
+def non_duplicate_errors(e):
+    """أخطاء BulkWriteError غير 11000 (المكرر يعني أن الكتابة تمت في تشغيل سابق)"""
+    return [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+
+class WriteBehind:
+    """
+    طابور كتابات (UpdateOp / InsertOp لكل collection بالاسم) يُفرغ بـ bulk_write غير مرتب
+    عند امتلاء الدفعة أو كل WRITE_BEHIND_INTERVAL، ويُفرغ بالكامل عند إيقاف السيرفر.
+    """
+
+    def __init__(self, batch=WRITE_BEHIND_BATCH, interval=WRITE_BEHIND_INTERVAL):
+        self.batch = batch
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=WRITE_BEHIND_MAX_PENDING)
+        self._stop = threading.Event()
+        self._thread = None
+        # {collection: دالة تحوّل الدفعة قبل أول محاولة كتابة} - مثلاً ترقيم order_events برحلة واحدة
+        self.prepare = {}
+        # دفعات WRITE_BEHIND_NEVER_DROP بالترتيب: [[collection, ops, prepared?], ...]
+        self._backlog = deque()
+        self._backlog_lock = threading.Lock()
+        self._backlog_failing = False
+        self.flushed = 0
+        self.dropped = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, collection_name, op):
+        if self._thread is None or self._stop.is_set():
+            self._flush([(collection_name, op)], final=True)
+            return
+        try:
+            self._queue.put_nowait((collection_name, op))
+        except queue.Full:
+            if collection_name in WRITE_BEHIND_NEVER_DROP:
+                # لا نتخطى ما سبقها في الطابور - الخيط ينقله للـ backlog بسرعة فننتظر مكاناً
+                self._queue.put((collection_name, op))
+                return
+            # الطابور ممتلئ (MongoDB بطيء) - نكتب مباشرة بدل أن نفقد الكتابة
+            self._flush([(collection_name, op)], drain=False)
+
+    def _collect(self, wait=True):
+        ops = []
+        deadline = time.monotonic() + self.interval
+        while len(ops) < self.batch:
+            try:
+                if wait:
+                    ops.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0.001)))
+                else:
+                    ops.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if wait and time.monotonic() >= deadline:
+                break
+        return ops
+
+    def _write(self, collection, name, group):
+        """محاولة كتابة دفعة واحدة - يرجع عدد الكتابات المرفوضة نهائياً، أو يرفع خطأ الاتصال"""
+        if collection is None:
+            raise ConnectionFailure(f"{name} not connected")
+        try:
+            collection.bulk_write(group, ordered=False)
+            return 0
+        except BulkWriteError as e:
+            # لا فائدة من إعادة كتابة مرفوضة، والمكرر (11000) يعني أنها كُتبت في محاولة سابقة
+            errors = non_duplicate_errors(e)
+            if errors:
+                print(f"Write-behind errors on {name}: {errors[:3]}")
+            return len(errors)
+
+    def _flush(self, ops, drain=True, final=False):
+        grouped = {}
+        for name, op in ops:
+            grouped.setdefault(name, []).append(op)
+        collections = mongo_collections()
+        for name, group in grouped.items():
+            if name in WRITE_BEHIND_NEVER_DROP:
+                with self._backlog_lock:
+                    self._backlog.append([name, group, name not in self.prepare])
+                continue
+            if collections.get(name) is None:
+                self.dropped += len(group)
+                print(f"❌ Write-behind: {name} not connected - dropped {len(group)} writes")
+                continue
+            prepared = name not in self.prepare
+            for attempt in range(WRITE_BEHIND_RETRIES):
+                try:
+                    if not prepared:
+                        group = self.prepare[name](group)
+                        prepared = True
+                    rejected = self._write(collections.get(name), name, group)
+                    self.dropped += rejected
+                    self.flushed += len(group) - rejected
+                    break
+                except Exception as e:
+                    print(f"Write-behind flush to {name} failed (attempt {attempt + 1}): {e}")
+                    time.sleep(0.5 * (2 ** attempt))
+            else:
+                self.dropped += len(group)
+        if drain or final:
+            self._drain_backlog(collections, final)
+
+    def _drain_backlog(self, collections, final=False):
+        """يكتب دفعات الـ backlog بالترتيب - يتوقف عند أول فشل ويعيد المحاولة في الدورة التالية"""
+        with self._backlog_lock:
+            while self._backlog:
+                entry = self._backlog[0]
+                name = entry[0]
+                for attempt in range(WRITE_BEHIND_RETRIES if final else 1):
+                    try:
+                        if not entry[2]:
+                            # الترقيم مرة واحدة فقط - إعادة المحاولة تكتب نفس الأرقام
+                            entry[1] = self.prepare[name](entry[1])
+                            entry[2] = True
+                        rejected = self._write(collections.get(name), name, entry[1])
+                        self.dropped += rejected
+                        self.flushed += len(entry[1]) - rejected
+                        break
+                    except Exception as e:
+                        if not self._backlog_failing:
+                            print(f"⚠️ Write-behind: {name} unavailable ({e}) - keeping {len(self._backlog)} batches to retry")
+                        self._backlog_failing = True
+                        if final:
+                            time.sleep(0.5 * (2 ** attempt))
+                else:
+                    if not final:
+                        return
+                    # إيقاف السيرفر والكتابة ما زالت تفشل - لا يوجد ما نفعله أكثر
+                    self.dropped += len(entry[1])
+                    print(f"❌ Write-behind: dropped {len(entry[1])} {name} writes at shutdown")
+                self._backlog.popleft()
+                self._backlog_failing = False
+
+    def _loop(self):
+        while not self._stop.is_set():
+            ops = self._collect()
+            if ops or self._backlog:
+                self._flush(ops)
+
+    def close(self, timeout=10):
+        """إيقاف نظيف: ينهي الدفعة الحالية ثم يكتب كل ما بقي في الطابور"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        while True:
+            ops = self._collect(wait=False)
+            if not ops:
+                break
+            self._flush(ops, final=True)
+        self._flush([], final=True)
+
+    def stats(self):
+        return {"pending": self._queue.qsize(), "backlog": sum(len(entry[1]) for entry in list(self._backlog)),
+                "flushed": self.flushed, "dropped": self.dropped}
+
+write_behind = WriteBehind()
+write_behind.start()
+atexit.register(write_behind.close)
+
+CUSTOMER_CACHE_MAX = int(os.getenv('CUSTOMER_CACHE_MAX', 5000))
+CUSTOMER_CACHE_TTL = float(os.getenv('CUSTOMER_CACHE_TTL', 300))
+CUSTOMER_NEGATIVE_TTL = 30   # زبون جديد قد يُحفظ من worker آخر - لا نتذكر "غير موجود" طويلاً
+
+class CustomerCache:
+    """LRU + TTL للزبائن حسب البصمة، مع تخزين "غير موجود" أيضاً"""
+
+    _MISSING = object()
+
+    def __init__(self, max_size=CUSTOMER_CACHE_MAX, ttl=CUSTOMER_CACHE_TTL, negative_ttl=CUSTOMER_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()   # {fingerprint: (expires_at, customer or None)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint):
+        """يرجع الزبون (نسخة)، أو None إذا معروف أنه غير موجود، أو _MISSING إذا لا يوجد في الكاش"""
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return self._MISSING
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return dict(entry[1]) if entry[1] is not None else None
+
+    def put(self, fingerprint, customer):
+        ttl = self.ttl if customer is not None else self.negative_ttl
+        with self._lock:
+            self._entries[fingerprint] = (time.monotonic() + ttl, dict(customer) if customer is not None else None)
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def record_visit(self, fingerprint, data):
+        """
+        زيارة محفوظة: تُطبق على زبون مخزن كاملاً فقط. غير ذلك (غير موجود أو "غير موجود") نحذف المدخل
+        ويُقرأ من MongoDB عند الحاجة - لا نخترع وثيقة لا نعرف visitCount الحقيقي فيها. لا يغير hits/misses.
+        """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None or entry[1] is None or entry[0] < time.monotonic():
+                self._entries.pop(fingerprint, None)
+                return
+            customer = entry[1]
+            self._entries[fingerprint] = (entry[0], {
+                **customer,
+                **data,
+                'visitCount': customer.get('visitCount', 0) + 1
+            })
+
+    def stats(self):
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+customer_cache = CustomerCache()
+
 def get_customer_data(fingerprint):
-    """الحصول على بيانات زبون معين من MongoDB"""
+    """الحصول على بيانات زبون معين (من الكاش، وإلا من MongoDB)"""
+    customer = customer_cache.get(fingerprint)
+    if customer is not CustomerCache._MISSING:
+        return customer
     if db_customers is not None:
         try:
-            return db_customers.find_one({'_id': fingerprint})
+            customer = db_customers.find_one({'_id': fingerprint})
         except Exception as e:
             print(f"Error reading customer: {e}")
             return None
+        customer_cache.put(fingerprint, customer)
+        return customer
     return None
 
 def save_customer_data(fingerprint, data):
-    """حفظ بيانات زبون في MongoDB"""
-    if db_customers:
+    """حفظ بيانات زبون - الكاش فوراً، وMongoDB عبر write-behind (لا ينتظر الرد)"""
+    if db_customers is not None:
         try:
             update_data = {
                 **data,
-                'lastVisit': datetime.now().isoformat()
+                'lastVisit': now_local()
             }
             # Upsert: Update if exists, Insert if not
-            db_customers.update_one(
+            write_behind.submit('customers', UpdateOp(
                 {'_id': fingerprint},
                 {
                     '$set': update_data,
                     '$inc': {'visitCount': 1}
                 },
                 upsert=True
-            )
-            print(f"💾 Customer {fingerprint} saved to MongoDB")
+            ))
+            # الكاش يعكس الكتابة مباشرة حتى لو لم تصل MongoDB بعد
+            customer_cache.record_visit(fingerprint, update_data)
+            print(f"💾 Customer {fingerprint} queued for MongoDB")
         except Exception as e:
             print(f"Error saving customer: {e}")
 
@@ -117,6 +1182,119 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 if not OPENAI_API_KEY:
     print('⚠️  تحذير: مفتاح OpenAI غير مُعد! أضفه في متغيرات البيئة')
 
+# ═══════════════════════════════════════════════════════════════════════════
+# 🤖 عميل OpenAI (Connection Pool + Timeouts + Retry)
+# ═══════════════════════════════════════════════════════════════════════════
+
+# OPENAI_BASE_URL يسمح بتوجيه الطلبات لسيرفر تجريبي محلي بدل OpenAI
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5))
+OPENAI_READ_TIMEOUT = float(os.getenv('OPENAI_READ_TIMEOUT', 30))
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', 8))
+OPENAI_QUEUE_TIMEOUT = float(os.getenv('OPENAI_QUEUE_TIMEOUT', 10))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', 2))
+
+class LLMBusyError(Exception):
+    """كل خانات الاتصال بـ OpenAI مشغولة لفترة أطول من المسموح"""
+
+class LLMClient:
+    """اتصال HTTP دائم (keep-alive) مع OpenAI، مع حد للطلبات المتزامنة وإعادة المحاولة عند 429/5xx"""
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, api_key, base_url=OPENAI_BASE_URL, model=OPENAI_MODEL,
+                 max_concurrency=OPENAI_MAX_CONCURRENCY, max_retries=OPENAI_MAX_RETRIES):
+        self.base_url = base_url
+        self.model = model
+        self.max_retries = max_retries
+        self.timeout = (OPENAI_CONNECT_TIMEOUT, OPENAI_READ_TIMEOUT)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        })
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def _backoff(self, attempt, response=None):
+        """Full jitter، مع احترام Retry-After إذا أرسله السيرفر"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        try:
+            if retry_after:
+                return min(float(retry_after), 10.0)
+        except ValueError:
+            pass
+        return random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+
+    def _post(self, path, payload, stream=False):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout, stream=stream)
+            except requests.ConnectionError:
+                # ConnectTimeout يرث من ConnectionError - أما ReadTimeout فلا نعيده حتى لا نضاعف الانتظار
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._backoff(attempt))
+                continue
+            if response.status_code in self.RETRY_STATUSES and attempt < self.max_retries:
+                response.close()
+                print(f"⚠️ OpenAI {response.status_code} - retry {attempt + 1}/{self.max_retries}")
+                time.sleep(self._backoff(attempt, response))
+                continue
+            response.raise_for_status()
+            return response
+
+    def chat(self, messages, max_tokens=500, temperature=0.7):
+        """طلب chat completion - يرجع نص الرد"""
+        if not self._slots.acquire(timeout=OPENAI_QUEUE_TIMEOUT):
+            raise LLMBusyError()
+        try:
+            response = self._post("/chat/completions", {
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature
+            })
+            result = response.json()
+            usage = result.get('usage') or {}
+            cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+            print(f"🧮 OpenAI tokens: prompt {usage.get('prompt_tokens', '?')} (cached {cached}), completion {usage.get('completion_tokens', '?')}")
+            return result['choices'][0]['message']['content']
+        finally:
+            self._slots.release()
+
+    def stream_chat(self, messages, max_tokens=500, temperature=0.7):
+        """نفس chat لكن يرجع أجزاء النص أولاً بأول (stream من OpenAI)"""
+        if not self._slots.acquire(timeout=OPENAI_QUEUE_TIMEOUT):
+            raise LLMBusyError()
+        try:
+            response = self._post("/chat/completions", {
+                "model": self.model,
+                "messages": messages,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+                "stream": True
+            }, stream=True)
+            with response:
+                for raw in response.iter_lines():
+                    line = raw.decode('utf-8')
+                    if not line.startswith('data: '):
+                        continue
+                    chunk = line[6:].strip()
+                    if chunk == '[DONE]':
+                        break
+                    choices = json.loads(chunk).get('choices') or [{}]
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+        finally:
+            self._slots.release()
+
+llm = LLMClient(OPENAI_API_KEY)
+
 # ═══════════════════════════════════════════════════════════════════════════
 # 🚀 إنشاء التطبيق وإعداد المسارات
 # ═══════════════════════════════════════════════════════════════════════════
@@ -126,10 +1304,31 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CUSTOMERS_DIR = os.path.join(BASE_DIR, '../frontend-customers')
 STAFF_DIR = os.path.join(BASE_DIR, '../frontend-staff')
 
+class JSONProvider(DefaultJSONProvider):
+    """التواريخ في الـ API بصيغة ISO 8601 (مع فرق التوقيت) بدل صيغة HTTP الافتراضية"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+# عدد البروكسيات أمام السيرفر (Render/Nginx) - ProxyFix يأخذ العنوان الذي أضافه آخرها إلى X-Forwarded-For
+# وليس أول قيمة (يكتبها العميل بنفسه). 0 = السيرفر مكشوف مباشرة.
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 1))
+
 app = Flask(__name__)
+app.json_provider_class = JSONProvider
+app.json = JSONProvider(app)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 CORS(app)
 sock = Sock(app)
 
+# Ping/Pong على مستوى البروتوكول: simple-websocket يغلق السوكيت إذا لم يصل pong خلال الفترة
+WS_PING_INTERVAL = int(os.getenv('WS_PING_INTERVAL', 25))
+app.config['SOCK_SERVER_OPTIONS'] = {'ping_interval': WS_PING_INTERVAL}
+
 # ═══════════════════════════════════════════════════════════════════════════
 # 🌐 خدمة الملفات الثابتة (Frontend Serving)
 # ═══════════════════════════════════════════════════════════════════════════
@@ -162,135 +1361,1007 @@ def serve_staff_static(path):
         return send_from_directory(STAFF_DIR, path)
     return "Not Found", 404
 
+# ═══════════════════════════════════════════════════════════════════════════
+# 📒 سجل الطلبات المحلي (Journal) - الطلبات لا تضيع عندما يكون MongoDB غير متاح
+# ═══════════════════════════════════════════════════════════════════════════
+
+JOURNAL_PATH = os.getenv('JOURNAL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'order_journal.jsonl'))
+JOURNAL_FSYNC_WINDOW = 0.005      # fsync واحد لكل الطلبات التي تصل خلال هذه النافذة
+JOURNAL_REPLAY_SECONDS = 5
+JOURNAL_REPLAY_CONCURRENCY = 4
+JOURNAL_COMPACT_LINES = 1000      # تنظيف سطور "ids" المتراكمة عندما لا يبقى شيء معلق
+
+class OrderJournal:
+    """
+    ملف append-only مشترك بين الـ workers (سطر JSON لكل سجل): {"op": "order", "key", "order"} عند القبول،
+    و{"op": "replayed", "key"} بعد وصوله لـ MongoDB، و{"op": "ids", "upTo"} لأرقام الطلبات المحجوزة على هذا الجهاز.
+    كل سطر يُكتب للملف فوراً تحت قفل ملف مشترك، و append ينتظر fsync الذي يُجمع لكل ما كُتب في نفس اللحظة.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.pending = OrderedDict()      # {key: order} لم يصل MongoDB بعد
+        self._cond = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._lines = 0
+        self._load()
+        self._file = open(path, 'a', encoding='utf-8')
+        threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def _read(self):
+        """(الطلبات المعلقة من كل الـ workers، أعلى رقم طلب محجوز أو مستخدم) كما في الملف"""
+        pending, taken = OrderedDict(), 0
+        if not os.path.exists(self.path):
+            return pending, taken
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = _decode(line)
+                except ValueError:
+                    continue    # سطر أخير ناقص (انقطاع أثناء الكتابة) - لم يُؤكد للزبون أصلاً
+                if record['op'] == 'order':
+                    pending[record['key']] = record['order']
+                    taken = max(taken, record['order']['id'])
+                elif record['op'] == 'replayed':
+                    pending.pop(record['key'], None)
+                elif record['op'] == 'ids':
+                    taken = max(taken, record['upTo'])
+        return pending, taken
+
+    def _load(self):
+        self.pending = self._read()[0]
+        if self.pending:
+            print(f"📒 Journal: {len(self.pending)} orders waiting for MongoDB")
+
+    def _flock(self, mode):
+        journal = self
+
+        class _Lock:
+            # يُستدعى والـ _cond مأخوذ: flock واحد لكل عملية، والـ threads تتسلسل على _cond
+            def __enter__(self):
+                fcntl.flock(journal._file.fileno(), mode)
+
+            def __exit__(self, exc_type, exc, tb):
+                fcntl.flock(journal._file.fileno(), fcntl.LOCK_UN)
+        return _Lock()
+
+    def _write(self, record):
+        # يُستدعى والـ _cond مأخوذ
+        self._file.write(_encode(record) + '\n')
+        self._file.flush()            # في الملف فوراً حتى يراه compact في باقي الـ workers
+        self._written += 1
+        self._lines += 1
+        self._cond.notify_all()
+        return self._written
+
+    def _append(self, record, durable=True):
+        with self._cond:
+            with self._flock(fcntl.LOCK_SH):
+                target = self._write(record)
+            while durable and self._synced < target:
+                self._cond.wait()
+
+    def _sync_loop(self):
+        while True:
+            with self._cond:
+                while self._synced == self._written:
+                    self._cond.wait()
+            time.sleep(JOURNAL_FSYNC_WINDOW)
+            with self._cond:
+                target = self._written
+            os.fsync(self._file.fileno())
+            with self._cond:
+                self._synced = target
+                self._cond.notify_all()
+
+    def record_order(self, order):
+        """يحفظ الطلب على القرص (بعد fsync) - يرجع مفتاح السجل (journalKey الموجود في الطلب إن وجد)"""
+        key = order.setdefault('journalKey', uuid.uuid4().hex)
+        self._append({'op': 'order', 'key': key, 'order': order})
+        self.pending[key] = order
+        return key
+
+    def mark_replayed(self, key):
+        # لا ننتظر fsync: إذا ضاع هذا السطر يُعاد الإرسال، والإعادة آمنة
+        self._append({'op': 'replayed', 'key': key}, durable=False)
+        self.pending.pop(key, None)
+
+    def note_ids(self, up_to):
+        """كتلة أرقام حجزها هذا الـ worker من MongoDB - claim_id في باقي الـ workers يبدأ بعدها"""
+        self._append({'op': 'ids', 'upTo': up_to}, durable=False)
+        if self._lines >= JOURNAL_COMPACT_LINES and not self.pending:
+            self.compact()
+
+    def claim_id(self, floor):
+        """رقم طلب بدون MongoDB فوق كل ما حجزه أو استخدمه أي worker على هذا الجهاز (و floor)"""
+        with self._cond:
+            with self._flock(fcntl.LOCK_EX):
+                order_id = max(self._read()[1], floor) + 1
+                self._write({'op': 'ids', 'upTo': order_id})
+        return order_id
+
+    def compact(self):
+        """يفرغ الملف فقط إذا وصلت كل طلباته - من كل الـ workers - لـ MongoDB، ويبقي أعلى رقم محجوز"""
+        with self._cond:
+            while self._synced < self._written:
+                self._cond.wait()
+            with self._flock(fcntl.LOCK_EX):
+                pending, taken = self._read()
+                if pending:
+                    return False
+                self._file.truncate(0)
+                if taken:
+                    self._write({'op': 'ids', 'upTo': taken})
+                self._lines = 0
+        return True
+
+    def pending_orders(self):
+        return list(self.pending.values())
+
+journal = OrderJournal()
+
+# ═══════════════════════════════════════════════════════════════════════════
+# ⚡ كاش الطلبات في الذاكرة (Write-through + Change Stream)
+# ═══════════════════════════════════════════════════════════════════════════
+
+ORDERS_WINDOW = 100  # عدد الطلبات التي تعرضها الشاشات (نفس الحد القديم)
+ORDER_CACHE_MAX = int(os.getenv('ORDER_CACHE_MAX', 2000))
+ORDER_CACHE_POLL_SECONDS = float(os.getenv('ORDER_CACHE_POLL_SECONDS', 2))
+
+class OrderCache:
+    """نسخة محلية من الطلبات الحية، تتحدث عند كل كتابة وعبر Change Stream من باقي الـ workers"""
+
+    def __init__(self, max_size=ORDER_CACHE_MAX):
+        self.max_size = max_size
+        self._orders = {}        # {order_id: order}
+        self._recent = None      # قائمة مرتبة تنازلياً (تُبنى عند الحاجة)
+        self._lock = threading.Lock()
+        # ينبه طلبات الـ long-poll و SSE المنتظرة عند وصول طلب جديد
+        self._arrived = threading.Condition(self._lock)
+        self._arrivals = deque(maxlen=ORDER_CACHE_MAX)   # [(version, order_id), ...]
+        self.version = 0
+        self.loaded = False
+        self.mode = 'idle'       # idle / change_stream / polling
+
+    def load(self):
+        """تحميل كامل من MongoDB (عند التشغيل أو بعد فقدان التزامن)"""
+        if db_orders is None:
+            return False
+        try:
+            docs = list(db_orders.find().sort('id', -1).limit(self.max_size))
+        except Exception as e:
+            print(f"Error loading order cache: {e}")
+            return False
+        with self._lock:
+            fresh = {o['id']: o for o in docs}
+            # طلبات في الـ journal لم تصل MongoDB بعد - تبقى ظاهرة للشاشات
+            for order in journal.pending_orders():
+                fresh.setdefault(order['id'], order)
+            if self.loaded:
+                # في وضع القراءة الدورية هذه هي الطريقة الوحيدة لاكتشاف طلبات الـ workers الأخرى
+                for order_id in sorted(fresh.keys() - self._orders.keys()):
+                    self._record_arrival(order_id)
+            self._orders = fresh
+            self._recent = None
+            self.loaded = True
+        return True
+
+    def _record_arrival(self, order_id):
+        # يُستدعى والـ lock مأخوذ
+        self.version += 1
+        self._arrivals.append((self.version, order_id))
+        self._arrived.notify_all()
+
+    def wait_for_arrivals(self, after_version, timeout):
+        """ينتظر حتى يصل طلب جديد بعد after_version - يرجع (آخر version، الطلبات الجديدة)"""
+        with self._lock:
+            if self.version <= after_version:
+                self._arrived.wait(timeout)
+            ids = [order_id for version, order_id in self._arrivals if version > after_version]
+            orders = [dict(self._orders[i]) for i in ids if i in self._orders]
+            return self.version, orders
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def put(self, order):
+        with self._lock:
+            is_new = self.loaded and order['id'] not in self._orders
+            self._orders[order['id']] = dict(order)
+            if is_new:
+                self._record_arrival(order['id'])
+            self._recent = None
+            if len(self._orders) > self.max_size:
+                del self._orders[min(self._orders)]
+
+    def remove(self, order_id):
+        with self._lock:
+            if self._orders.pop(order_id, None) is not None:
+                self._recent = None
+
+    def get(self, order_id):
+        with self._lock:
+            order = self._orders.get(order_id)
+            return dict(order) if order is not None else None
+
+    def recent(self, limit=ORDERS_WINDOW):
+        """أحدث الطلبات كنسخ (حتى لا يعدّل المستدعي الكاش بالخطأ)"""
+        self._ensure_loaded()
+        with self._lock:
+            if self._recent is None:
+                self._recent = sorted(self._orders.values(), key=lambda o: o['id'], reverse=True)
+            return [dict(o) for o in self._recent[:limit]]
+
+    def __len__(self):
+        return len(self._orders)
+
+    def _handle_change(self, change):
+        op = change.get('operationType')
+        if op in ('insert', 'update', 'replace'):
+            doc = change.get('fullDocument')
+            if doc is not None:
+                self.put(doc)
+            else:
+                # المستند حُذف قبل ما نقرأه
+                self.remove(change['documentKey']['_id'])
+        elif op == 'delete':
+            self.remove(change['documentKey']['_id'])
+        elif op in ('drop', 'invalidate', 'dropDatabase', 'rename'):
+            self.load()
+
+    def sync_loop(self):
+        """مزامنة الكاش مع تغييرات باقي الـ workers - Change Stream وإلا تحديث دوري"""
+        resume_token = None
+        seen_version = None
+        while True:
+            if db_orders is None:
+                time.sleep(ORDER_CACHE_POLL_SECONDS)
+                continue
+            try:
+                with db_orders.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                    # نحمّل بعد فتح الـ stream حتى لا يضيع أي تغيير بينهما
+                    if resume_token is None:
+                        self.load()
+                    self.mode = 'change_stream'
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self._handle_change(change)
+            except Exception as e:
+                if self.mode != 'polling':
+                    print(f"⚠️ Change stream unavailable ({e}) - switching order cache to polling")
+                self.mode = 'polling'
+                resume_token = None
+                # Change streams need a replica set; standalone servers fall back to periodic reloads
+                # SQLite: إعادة التحميل فقط إذا كتب worker آخر في الملف منذ آخر تحميل
+                version = database.data_version() if STORAGE_BACKEND == 'sqlite' else None
+                if version is None or version != seen_version:
+                    if self.load():
+                        seen_version = version
+                time.sleep(ORDER_CACHE_POLL_SECONDS)
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🔢 مولّد أرقام الطلبات (Atomic Sequence)
+# ═══════════════════════════════════════════════════════════════════════════
+
+ORDER_ID_START = 1000
+ORDER_ID_BLOCK = int(os.getenv('ORDER_ID_BLOCK', 50))
+
+class Sequence:
+    """عداد ذرّي في collection counters عبر $inc - كل worker يحجز كتلة أرقام مرة واحدة"""
+
+    def __init__(self, name, start=0, block=ORDER_ID_BLOCK, floor=None, on_reserve=None):
+        self.name = name
+        self.start = start
+        self.block = block
+        self.floor = floor       # دالة ترجع أكبر رقم مستخدم فعلاً (إن وجد)
+        self.on_reserve = on_reserve   # تُستدعى بآخر رقم في كل كتلة جديدة
+        self._next = 0
+        self._limit = -1         # آخر رقم محجوز لهذا الـ worker
+        self._seeded = False
+        self._lock = threading.Lock()
+
+    def _seed(self):
+        """أول استخدام: نتأكد أن العداد لا يبدأ تحت أكبر رقم مستخدم"""
+        floor = max(self.start, self.floor() if self.floor else self.start)
+        db_counters.update_one({'_id': self.name}, {'$max': {'seq': floor}}, upsert=True)
+        self._seeded = True
+
+    def _reserve(self):
+        if not self._seeded:
+            self._seed()
+        doc = db_counters.find_one_and_update(
+            {'_id': self.name},
+            {'$inc': {'seq': self.block}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._limit = doc['seq']
+        self._next = self._limit - self.block + 1
+        if self.on_reserve:
+            self.on_reserve(self._limit)
+
+    def take(self, n):
+        """n أرقام متتالية جديدة برحلة واحدة (بدون الكتلة المحلية) - يرجع أولها"""
+        with self._lock:
+            if not self._seeded:
+                self._seed()
+            doc = db_counters.find_one_and_update(
+                {'_id': self.name},
+                {'$inc': {'seq': n}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return doc['seq'] - n + 1
+
+    def resync(self):
+        """بعد انقطاع: ننسى الكتلة المحجوزة ونعيد التأسيس من أكبر رقم في MongoDB"""
+        with self._lock:
+            self._next = 0
+            self._limit = -1
+            self._seeded = False
+
+    def next(self, local=False):
+        """local=True (بدون MongoDB): فقط من الكتلة المحجوزة مسبقاً - None إذا انتهت"""
+        with self._lock:
+            if self._next > self._limit:
+                if local or db_counters is None:
+                    return None
+                self._reserve()
+            value = self._next
+            self._next += 1
+            return value
+
+def max_id(collection):
+    """أكبر _id في collection (أو 0)"""
+    if collection is None:
+        return 0
+    last = collection.find_one(sort=[('_id', -1)], projection={'_id': 1})
+    return last['_id'] if last else 0
+
 # ═══════════════════════════════════════════════════════════════════════════
 # 💾 قاعدة البيانات (MongoDB Wrapper)
 # ═══════════════════════════════════════════════════════════════════════════
 
+# الانتقالات المسموحة لحالة الطلب
+ORDER_TRANSITIONS = {
+    'new': ('preparing', 'cancelled'),
+    'preparing': ('ready', 'cancelled'),
+    'ready': ('delivered', 'cancelled'),
+    'delivered': (),
+    'cancelled': ()
+}
+
+# سجل تغييرات الطلبات (order_events) - الشاشات تسحب التغييرات بعد آخر cursor بدل كل الطلبات
+ORDER_EVENTS_TTL_SECONDS = int(os.getenv('ORDER_EVENTS_TTL_SECONDS', 24 * 3600))
+ORDER_EVENTS_SETTLE_SECONDS = 15  # مهلة انتظار رقم ناقص (كتابة مؤجلة لم تصل بعد، قد تشمل إعادة محاولات)
+ORDER_EVENTS_PAGE = 500
+
+# إشعارات الجاهزية: collection صغيرة مفهرسة على at (BSON datetime) بدل فحص كل الطلبات
+READY_NOTIFICATIONS_TTL_SECONDS = 24 * 3600
+READY_NOTIFICATIONS_LIMIT = 100
+
+class OrderNotSavedError(Exception):
+    """الطلب لم يُحفظ لا في MongoDB ولا في الـ journal - لا نعطي الزبون رقماً"""
+
 class Database:
     def __init__(self):
-        # لم نعد نستخدم القائمة المحلية، بل نعتمد على MongoDB مباشرة
-        pass
+        # الطلبات تُقرأ من الكاش المحلي، وMongoDB يبقى مصدر الحقيقة
+        self.cache = OrderCache()
+        # كل كتلة تُسجل في الـ journal حتى لا يعطي worker آخر أرقامها بدون اتصال
+        self.order_ids = Sequence('orders', start=ORDER_ID_START, floor=lambda: max_id(db_orders),
+                                  on_reserve=journal.note_ids)
+        # أرقام الأحداث تُحجز لكل دفعة write-behind ($inc واحد) وليس لكل حدث - انظر number_events
+        self.event_ids = Sequence('order_events', floor=lambda: max_id(db_order_events))
+        self._event_seq = None       # أعلى رقم حدث نعرفه (أرقامنا وما قرأناه من السجل) - انظر event_cursor
+        self._event_seq_lock = threading.Lock()
+
+    def log_event(self, op, order_id=None, data=None):
+        """يسجل تغييراً في order_events: create / update / delete / purge (بدون أي رحلة لـ MongoDB)"""
+        if db_order_events is None:
+            return
+        # الطلب نفسه كُتب قبل هذا - الحدث يُرقّم ويُكتب مع دفعته
+        write_behind.submit('order_events', {'op': op, 'orderId': order_id, 'data': data})
+
+    def number_events(self, events):
+        """
+        write-behind: يحوّل دفعة أحداث لـ InsertOp بأرقام متتالية من $inc واحد، بنفس ترتيب وقوعها.
+        الرقم يُحجز قبل الكتابة مباشرة، فرقم ناقص عند القارئ يعني دفعة worker آخر في الطريق.
+        """
+        first = self.event_ids.take(len(events))
+        self._note_event_seq(first + len(events) - 1)
+        at = now_local()
+        return [InsertOp({**event, '_id': first + i, 'at': at}) for i, event in enumerate(events)]
+
+    def add_ready_notification(self, order, at):
+        """
+        يسجل إشعار الجاهزية في ready_notifications. at هو وقت الـ PATCH نفسه:
+        الفلتر على at والشاشة ترى timestamp، فيجب أن يكونا نفس اللحظة وإلا يتكرر آخر إشعار مع since=timestamp.
+        """
+        if db_ready_notifications is None:
+            return
+        try:
+            db_ready_notifications.insert_one({
+                'orderId': order['id'],
+                'orderType': order.get('orderType', 'dine_in'),
+                'message': order['readyNotification']['message'],
+                'timestamp': at,
+                'at': at
+            })
+        except Exception as e:
+            print(f"Error saving ready notification: {e}")
+
+    def ready_notifications_since(self, since, limit=READY_NOTIFICATIONS_LIMIT):
+        """إشعارات الجاهزية بعد since - range scan على فهرس at"""
+        if db_ready_notifications is None:
+            return []
+        try:
+            return list(db_ready_notifications.find(
+                {'at': {'$gt': since}},
+                projection={'_id': 0, 'at': 0}
+            ).sort('at', 1).limit(limit))
+        except Exception as e:
+            print(f"Error fetching ready notifications: {e}")
+            return []
+
+    def _note_event_seq(self, seq):
+        with self._event_seq_lock:
+            self._event_seq = max(self._event_seq or 0, seq)
+
+    def event_cursor(self):
+        """
+        آخر رقم حدث - تأخذه الشاشة مع القائمة الكاملة ثم تسحب ما بعده.
+        من الذاكرة بدون رحلة لـ MongoDB (إلا أول مرة): رقم أقل من الحقيقي يعني فقط أحداثاً تعرفها الشاشة تصلها مرة ثانية.
+        """
+        if self._event_seq is None:
+            return self.latest_event_seq()
+        return self._event_seq
+
+    def latest_event_seq(self):
+        """آخر رقم حدث في MongoDB نفسه"""
+        try:
+            seq = max_id(db_order_events)
+        except Exception as e:
+            print(f"Error reading order_events cursor: {e}")
+            return self._event_seq or 0
+        self._note_event_seq(seq)
+        return seq
+
+    def events_after(self, cursor, limit=ORDER_EVENTS_PAGE):
+        """
+        الأحداث بعد cursor بالترتيب - يرجع (events, cursor الجديد, resync).
+        resync=True يعني أن cursor أقدم من السجل (TTL أو مسح) والشاشة يجب أن تعيد التحميل الكامل.
+        """
+        if db_order_events is None:
+            return [], cursor, False
+        oldest = db_order_events.find_one(sort=[('_id', 1)], projection={'_id': 1})
+        if oldest is not None and cursor < oldest['_id'] - 1:
+            # الرقم من MongoDB وليس من الذاكرة: يجب أن يكون بعد أقدم حدث وإلا تتكرر إعادة التحميل
+            return [], self.latest_event_seq(), True
+        docs = db_order_events.find({'_id': {'$gt': cursor}}).sort('_id', 1).limit(limit)
+        now = now_local()
+        events = []
+        for doc in docs:
+            # الأرقام تُحجز قبل الكتابة: رقم ناقص حديث يعني حدثاً في الطريق، فنتوقف عنده
+            # حتى لا يتخطاه الـ cursor. بعد المهلة نعتبره كتابة فشلت ونكمل.
+            if doc['_id'] != cursor + 1 and now - doc['at'] < timedelta(seconds=ORDER_EVENTS_SETTLE_SECONDS):
+                break
+            cursor = doc['_id']
+            self._note_event_seq(cursor)
+            if doc['op'] == 'purge':
+                return events, cursor, True
+            events.append({
+                'seq': doc['_id'],
+                'op': doc['op'],
+                'orderId': doc.get('orderId'),
+                'data': doc.get('data')
+            })
+        return events, cursor, False
 
     @property
     def orders(self):
-        """جلب جميع الطلبات من MongoDB كقائمة (للتوافق مع الكود القديم)"""
-        if db_orders is not None:
-            try:
-                # جلب آخر 100 طلب فقط للأداء، مرتبة تنازلياً
-                cursor = db_orders.find().sort('id', -1).limit(100)
-                return list(cursor)
-            except Exception as e:
-                print(f"Error fetching orders: {e}")
-                return []
-        return []
+        """آخر 100 طلب مرتبة تنازلياً (من الكاش بدون رحلة لـ MongoDB)"""
+        return self.cache.recent(ORDERS_WINDOW)
 
-    @property
-    def counter(self):
-        """الحصول على آخر ID للطلبات"""
-        if db_orders is not None:
-            try:
-                last_order = db_orders.find_one(sort=[("id", -1)])
-                if last_order:
-                    return last_order['id']
-            except:
-                pass
-        return 1000
+    def get_order(self, order_id, fresh=False):
+        """طلب واحد بالرقم - من الكاش، وإلا find_one على _id. مع fresh=True أخطاء MongoDB تصل للمستدعي"""
+        self.cache._ensure_loaded()
+        order = None if fresh else self.cache.get(order_id)
+        if order is not None or db_orders is None:
+            return order
+        try:
+            order = db_orders.find_one({'_id': order_id})
+        except Exception as e:
+            if fresh:
+                raise
+            print(f"Error fetching order #{order_id}: {e}")
+            return None
+        if order is not None:
+            self.cache.put(order)
+        return order
 
-    @counter.setter
-    def counter(self, value):
-        pass
+    def next_order_id(self):
+        """رقم الطلب التالي (فريد بين كل الـ workers)"""
+        if db_counters is None or _mongo_down:
+            return self.next_offline_order_id()
+        try:
+            return self.order_ids.next()
+        except ConnectionFailure as e:
+            mark_mongo_down(e)
+            return self.next_offline_order_id()
+
+    def next_offline_order_id(self):
+        """
+        بدون MongoDB: أولاً باقي الكتلة المحجوزة لهذا الـ worker، ثم رقم من الـ journal فوق كل كتل وطلبات
+        الـ workers على هذا الجهاز - فلا يتكرر رقم ولا يحتاج الـ replay لتغيير رقم أعطيناه للزبون.
+        """
+        order_id = self.order_ids.next(local=True)
+        if order_id is None:
+            known = [o['id'] for o in self.cache.recent(1)]
+            order_id = journal.claim_id(max(known + [ORDER_ID_START]))
+        return order_id
 
     def add_order(self, order):
-        """إضافة طلب جديد إلى MongoDB"""
-        if db_orders is not None:
+        """
+        إضافة طلب جديد إلى MongoDB - وإذا فشلت الكتابة لأي سبب إلى الـ journal المحلي (يُعاد إرساله لاحقاً).
+        يرفع OrderNotSavedError إذا الرقم مأخوذ (DuplicateKeyError) أو فشلت كتابة الـ journal.
+        """
+        # استخدام _id كـ id الطلب للسهولة
+        order['_id'] = order['id']
+        # مفتاح الـ journal قبل أول محاولة: انقطاع بعد أن نجح الـ insert لا ينتج نسخة ثانية عند الـ replay
+        order['journalKey'] = uuid.uuid4().hex
+        if db_orders is not None and not _mongo_down:
             try:
-                # استخدام _id كـ id الطلب للسهولة
-                order['_id'] = order['id']
                 db_orders.insert_one(order)
+                self.cache.put(order)
+                self.log_event('create', order['id'], {k: v for k, v in order.items() if k != '_id'})
                 print(f"💾 Order #{order['id']} saved to MongoDB")
+                return
+            except DuplicateKeyError as e:
+                # رقم أعطاه سيرفر آخر - الـ journal كان سيعيد ترقيمه بعد أن رأى الزبون الرقم
+                raise OrderNotSavedError(f"order id #{order['id']} already taken") from e
+            except ConnectionFailure as e:
+                mark_mongo_down(e)
             except Exception as e:
-                print(f"Error adding order: {e}")
-        else:
-            print("❌ Error: MongoDB is not connected! Order NOT saved.")
+                # OperationFailure، SQLite "database is locked"... - الـ watchdog يعيد المحاولة
+                print(f"Error adding order #{order['id']} ({e}) - journaling")
+        # MongoDB غير متاح: الطلب محفوظ على القرص ويظهر للشاشات من الذاكرة، ويُرسل لاحقاً
+        try:
+            journal.record_order(order)
+        except OSError as e:
+            raise OrderNotSavedError(f"journal write failed: {e}") from e
+        self.cache.put(order)
+        print(f"📒 Order #{order['id']} journaled locally")
+
+    def replay_journal(self):
+        """يرسل طلبات الـ journal إلى MongoDB (آمن للتكرار) - يرجع عدد ما أُرسل"""
+        pending = list(journal.pending.items())
+        if not pending or db_orders is None:
+            return 0
+        # العداد يتجاوز كل الأرقام التي أُعطيت بدون اتصال قبل أي رقم جديد
+        db_counters.update_one({'_id': self.order_ids.name}, {'$max': {'seq': max(o['id'] for _, o in pending)}}, upsert=True)
+        self.order_ids.resync()
+        with ThreadPoolExecutor(max_workers=JOURNAL_REPLAY_CONCURRENCY) as pool:
+            results = list(pool.map(lambda item: self._replay_one(*item), pending))
+        replayed = sum(results)
+        if not journal.pending:
+            journal.compact()
+        print(f"📒 Journal: replayed {replayed}/{len(pending)} orders to MongoDB")
+        return replayed
+
+    def _replay_one(self, key, order):
+        order = dict(order)
+        try:
+            try:
+                db_orders.insert_one(order)
+            except DuplicateKeyError:
+                existing = db_orders.find_one({'_id': order['_id']}, projection={'journalKey': 1})
+                if existing is None or existing.get('journalKey') != key:
+                    # الأرقام المحلية لا تتداخل بين workers نفس الجهاز؛ هذا فقط إذا أعطى سيرفر آخر نفس الرقم
+                    old_id = order['id']
+                    order['id'] = order['_id'] = self.order_ids.next()
+                    db_orders.insert_one(order)
+                    cached = self.cache.get(old_id)
+                    if cached is not None and cached.get('journalKey') == key:
+                        self.cache.remove(old_id)
+                    print(f"⚠️ Journal: order #{old_id} renumbered to #{order['id']} (id taken on another server)")
+            self.cache.put(order)
+            self.log_event('create', order['id'], {k: v for k, v in order.items() if k != '_id'})
+            journal.mark_replayed(key)
+            return 1
+        except Exception as e:
+            print(f"Error replaying journaled order #{order['id']}: {e}")
+            return 0
+
+    def storage_watchdog(self):
+        """إعادة الاتصال بـ MongoDB عند الحاجة ثم إرسال الـ journal"""
+        while True:
+            try:
+                if journal.pending or db_orders is None or _mongo_down:
+                    if mongo_reachable():
+                        self.replay_journal()
+            except Exception as e:
+                print(f"Error in storage watchdog: {e}")
+            time.sleep(JOURNAL_REPLAY_SECONDS)
+
+    def transition_order(self, order_id, updates, to_status=None):
+        """
+        تحديث ذرّي برحلة واحدة - يرجع الطلب بعد التحديث، أو None إذا الطلب غير موجود أو الانتقال غير مسموح.
+        أخطاء MongoDB (أو عدم الاتصال) تُرفع للمستدعي حتى لا تُفهم كرفض للانتقال.
+        """
+        if db_orders is None:
+            raise ConnectionFailure("MongoDB is not connected")
+        query = {'_id': order_id}
+        if to_status is not None:
+            # compare-and-set: ينجح فقط إذا كانت الحالة الحالية تسمح بالانتقال
+            query['status'] = {'$in': [s for s, nxt in ORDER_TRANSITIONS.items() if to_status in nxt]}
+        order = db_orders.find_one_and_update(
+            query,
+            {'$set': updates},
+            return_document=ReturnDocument.AFTER
+        )
+        if order is not None:
+            self.cache.put(order)
+            self.log_event('update', order_id, updates)
+            print(f"💾 Order #{order_id} updated in MongoDB")
+        return order
 
-    def update_order(self, order_id, updates):
-        """تحديث طلب في MongoDB"""
+    def delete_order(self, order_id):
+        """حذف طلب من MongoDB - يرجع True إذا كان موجوداً"""
         if db_orders is not None:
             try:
-                db_orders.update_one(
-                    {'id': order_id},
-                    {'$set': updates}
-                )
-                print(f"💾 Order #{order_id} updated in MongoDB")
+                result = db_orders.delete_one({'id': order_id})
+                self.cache.remove(order_id)
+                if result.deleted_count > 0:
+                    self.log_event('delete', order_id)
+                return result.deleted_count > 0
             except Exception as e:
-                print(f"Error updating order: {e}")
+                print(f"Error deleting from Mongo: {e}")
+        return False
 
 db = Database()
+write_behind.prepare['order_events'] = db.number_events
+
+# Start order cache sync thread
+threading.Thread(target=db.cache.sync_loop, daemon=True).start()
+
+# Start storage watchdog (lazy reconnect + journal replay)
+threading.Thread(target=db.storage_watchdog, daemon=True).start()
 
 # ═══════════════════════════════════════════════════════════════════════════
 # 🔌 WebSocket Connection Manager
 # ═══════════════════════════════════════════════════════════════════════════
 
+WS_SEND_QUEUE_SIZE = int(os.getenv('WS_SEND_QUEUE_SIZE', 64))
+WS_MAX_CONNECTIONS = int(os.getenv('WS_MAX_CONNECTIONS', 500))    # لكل worker
+WS_MAX_PER_IP = int(os.getenv('WS_MAX_PER_IP', 20))
+WS_IDLE_TIMEOUT = int(os.getenv('WS_IDLE_TIMEOUT', 2 * 3600))    # بدون أي رسالة بالاتجاهين
+WS_REAP_INTERVAL = 30
+
+class ClientConnection:
+    """سوكيت واحد بطابور إرسال محدود وخيط كتابة خاص - العميل البطيء لا يؤخر الباقين"""
+
+    def __init__(self, ws, ip, on_close):
+        self.ws = ws
+        self.ip = ip
+        self.topics = set()
+        self.closed = False
+        self._close_reason = None
+        self._close_message = None
+        self.connected_at = time.monotonic()
+        self.last_activity = self.connected_at
+        self._queue = queue.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self._on_close = on_close
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def enqueue(self, payload):
+        """إضافة رسالة (نص JSON جاهز) بدون انتظار - الطابور الممتلئ يعني عميل عالق فنقطعه"""
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(payload)
+            return True
+        except queue.Full:
+            print("🐢 عميل بطيء - تم قطع الاتصال")
+            self.close(reason=1008, message='slow consumer')
+            return False
+
+    def _write_loop(self):
+        while True:
+            payload = self._queue.get()
+            if payload is None or self.closed:
+                break
+            try:
+                self.ws.send(payload)
+                self.last_activity = time.monotonic()
+            except Exception:
+                self.close()
+                break
+        # الإغلاق الفعلي هنا فقط: خيط واحد يكتب على السوكيت، وخيط الناشر لا ينتظر عميلاً عالقاً
+        try:
+            self.ws.close(reason=self._close_reason, message=self._close_message)
+        except Exception:
+            pass
+
+    def close(self, reason=None, message=None):
+        """يعلّم الاتصال مغلقاً ويوقظ خيط الكتابة - لا يلمس السوكيت (قد نكون في خيط الناشر)"""
+        if self.closed:
+            return
+        self._close_reason = reason
+        self._close_message = message
+        self.closed = True
+        # إيقاف خيط الكتابة حتى لو الطابور ممتلئ
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass    # خيط الكتابة يرى closed عند الرسالة التالية
+        # خيط الـ endpoint يلاحظ closed في ws.receive(timeout) ويخرج
+        self._on_close(self)
+
+# القنوات: order:<id> لزبون الطلب، staff لشاشات العمال، type:<orderType> لشاشة نوع واحد
+STAFF_TOPIC = 'staff'
+ORDER_TYPES = ('dine_in', 'car_pickup', 'delivery')
+
+def order_topic(order_id):
+    return f"order:{order_id}"
+
+def order_type_topic(order_type):
+    return f"type:{order_type}"
+
+def is_valid_topic(topic):
+    if topic == STAFF_TOPIC:
+        return True
+    kind, _, value = str(topic).partition(':')
+    if kind == 'order':
+        return value.isdigit()
+    return kind == 'type' and value in ORDER_TYPES
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections = {}  # {order_id: [ws, ...]}
-        self.all_connections = []     # [ws, ...]
+    def __init__(self, backplane):
+        self.connections = {}   # {ws: ClientConnection}
+        self.topics = {}        # {topic: {ClientConnection, ...}}
+        self.per_ip = {}        # {ip: عدد الاتصالات}
+        self.rejected = 0
+        self.reaped = 0
         self.lock = threading.Lock()
+        # كل إشعار يمر عبر الـ backplane حتى يصل لسوكيتات كل الـ workers
+        self.backplane = backplane
+        backplane.start(self.deliver)
     
-    def connect(self, ws, order_id=None):
+    def connect(self, ws, order_id=None, ip=None):
+        """تسجيل سوكيت (واشتراكه بقناة الطلب إذا وُجد رقم) - يرجع None إذا تجاوزنا الحدود"""
         with self.lock:
-            self.all_connections.append(ws)
-            if order_id:
-                if order_id not in self.active_connections:
-                    self.active_connections[order_id] = []
-                self.active_connections[order_id].append(ws)
-                print(f"🔗 عميل متصل لمتابعة الطلب #{order_id}")
-            else:
-                print(f"🔗 عميل متصل (بدون طلب محدد)")
+            conn = self.connections.get(ws)
+            if conn is None:
+                if len(self.connections) >= WS_MAX_CONNECTIONS or self.per_ip.get(ip, 0) >= WS_MAX_PER_IP:
+                    self.rejected += 1
+                    print(f"⛔ رفض اتصال WebSocket من {ip} (الحد الأقصى)")
+                    return None
+                conn = ClientConnection(ws, ip, self._forget)
+                self.connections[ws] = conn
+                self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+        if order_id:
+            self.subscribe(ws, order_topic(order_id))
+            print(f"🔗 عميل متصل لمتابعة الطلب #{order_id}")
+        else:
+            print(f"🔗 عميل متصل (بدون طلب محدد)")
+        return conn
+
+    def reply(self, ws, message):
+        """رسالة لسوكيت واحد عبر طابوره (حتى لا يكتب خيطان على نفس السوكيت)"""
+        conn = self.connections.get(ws)
+        if conn is not None:
+            conn.enqueue(json.dumps(message, ensure_ascii=False))
+
+    def touch(self, ws):
+        conn = self.connections.get(ws)
+        if conn is not None:
+            conn.last_activity = time.monotonic()
+
+    def subscribe(self, ws, topic):
+        with self.lock:
+            conn = self.connections.get(ws)
+            if conn is None or conn.closed:
+                return False
+            conn.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(conn)
+        return True
+
+    def unsubscribe(self, ws, topic):
+        with self.lock:
+            conn = self.connections.get(ws)
+            if conn is not None:
+                self._leave(conn, topic)
+
+    def _leave(self, conn, topic):
+        conn.topics.discard(topic)
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(conn)
+            if not subscribers:
+                del self.topics[topic]
+
+    def _forget(self, conn):
+        with self.lock:
+            if self.connections.get(conn.ws) is conn:
+                del self.connections[conn.ws]
+                remaining = self.per_ip.get(conn.ip, 1) - 1
+                if remaining > 0:
+                    self.per_ip[conn.ip] = remaining
+                else:
+                    self.per_ip.pop(conn.ip, None)
+            for topic in list(conn.topics):
+                self._leave(conn, topic)
 
     def disconnect(self, ws, order_id=None):
+        # order_id للتوافق فقط - الاتصال يعرف كل القنوات المشترك فيها
         with self.lock:
-            if ws in self.all_connections:
-                self.all_connections.remove(ws)
-            if order_id and order_id in self.active_connections:
-                if ws in self.active_connections[order_id]:
-                    self.active_connections[order_id].remove(ws)
-                if not self.active_connections[order_id]:
-                    del self.active_connections[order_id]
+            conn = self.connections.get(ws)
+        if conn is not None:
+            conn.close()
         print(f"🔌 عميل قطع الاتصال")
 
-    def broadcast(self, message):
+    def _fan_out(self, targets, message):
+        # تحويل JSON مرة واحدة، والإرسال نفسه في خيوط الكتابة بدون أي lock
+        msg_str = json.dumps(message, ensure_ascii=False)
+        for conn in targets:
+            conn.enqueue(msg_str)
+
+    def deliver(self, event):
+        """استقبال حدث من الـ backplane وتوزيعه على مشتركي قنواته في هذا الـ worker"""
         with self.lock:
-            msg_str = json.dumps(message)
-            to_remove = []
-            for ws in self.all_connections:
-                try:
-                    ws.send(msg_str)
-                except:
-                    to_remove.append(ws)
-            for ws in to_remove:
-                if ws in self.all_connections:
-                    self.all_connections.remove(ws)
-        
-        if message.get('type') == 'order_ready':
-            print(f"📢 تم بث إشعار جاهزية للجميع - الطلب #{message.get('orderId')}")
+            targets = set()
+            for topic in event['topics']:
+                targets.update(self.topics.get(topic, ()))
+        if targets:
+            self._fan_out(targets, event['message'])
 
-    def send_to_order(self, order_id, message):
+    def reap_loop(self):
+        """إغلاق الاتصالات الخاملة أو الميتة حتى تبقى الذاكرة وعدد الخيوط محدودة"""
+        while True:
+            time.sleep(WS_REAP_INTERVAL)
+            now = time.monotonic()
+            with self.lock:
+                stale = [
+                    conn for conn in self.connections.values()
+                    if now - conn.last_activity > WS_IDLE_TIMEOUT or not getattr(conn.ws, 'connected', True)
+                ]
+            for conn in stale:
+                conn.close(reason=1001, message='idle timeout')
+            if stale:
+                self.reaped += len(stale)
+                print(f"🧹 تم إغلاق {len(stale)} اتصال WebSocket خامل")
+
+    def stats(self):
         with self.lock:
-            if order_id in self.active_connections:
-                msg_str = json.dumps(message)
-                to_remove = []
-                for ws in self.active_connections[order_id]:
-                    try:
-                        ws.send(msg_str)
-                        print(f"📤 تم إرسال إشعار للطلب #{order_id}")
-                    except:
-                        to_remove.append(ws)
-                for ws in to_remove:
-                    if ws in self.active_connections[order_id]:
-                        self.active_connections[order_id].remove(ws)
+            return {
+                "worker": worker_id(),
+                "connections": len(self.connections),
+                "uniqueIps": len(self.per_ip),
+                "topics": len(self.topics),
+                "subscriptions": sum(len(subs) for subs in self.topics.values()),
+                "rejected": self.rejected,
+                "reaped": self.reaped,
+                "threads": threading.active_count(),
+                "limits": {"global": WS_MAX_CONNECTIONS, "perIp": WS_MAX_PER_IP, "idleTimeout": WS_IDLE_TIMEOUT}
+            }
 
-manager = ConnectionManager()
+    def publish(self, topics, message):
+        """إرسال رسالة لمشتركي قناة أو أكثر فقط - التكلفة بعدد المشتركين وليس بعدد كل السوكيتات"""
+        if isinstance(topics, str):
+            topics = [topics]
+        self.backplane.publish({'topics': list(topics), 'message': message})
+
+    def send_to_order(self, order_id, message):
+        self.publish(order_topic(order_id), message)
+        print(f"📤 تم إرسال إشعار للطلب #{order_id}")
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📡 Notification Backplane (بين الـ gunicorn workers)
+# ═══════════════════════════════════════════════════════════════════════════
+
+# mongo مع SQLite أيضاً: الـ workers يتبادلون الأحداث عبر جدول notifications (قراءة دورية)
+NOTIFY_BACKPLANE = os.getenv('NOTIFY_BACKPLANE', 'mongo')  # mongo / local
+NOTIFY_TTL_SECONDS = 3600
+NOTIFY_POLL_SECONDS = float(os.getenv('NOTIFY_POLL_SECONDS', 0.5))
+
+def worker_id():
+    # pid يُقرأ كل مرة لأن gunicorn --preload يعمل fork بعد الاستيراد
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class LocalBackplane:
+    """توصيل داخل نفس العملية فقط - worker واحد أو تجارب بدون MongoDB"""
+
+    mode = 'local'
+
+    def __init__(self):
+        self._handler = None
+
+    def start(self, handler):
+        self._handler = handler
+
+    def publish(self, event):
+        self._handler(event)
+
+class MongoBackplane(LocalBackplane):
+    """
+    كل worker يوصل الحدث لسوكيتاته مباشرة ويكتبه في collection notifications،
+    وباقي الـ workers يستقبلونه عبر Change Stream (أو قراءة دورية إذا غير مدعوم).
+    """
+
+    mode = 'mongo'
+
+    def start(self, handler):
+        self._handler = handler
+        self._seen = {}   # {_id: وقت الاستلام} لتجنب التكرار في وضع القراءة الدورية
+        threading.Thread(target=self._listen_loop, daemon=True).start()
+
+    def publish(self, event):
+        self._handler(event)
+        if db_notifications is None:
+            return
+        try:
+            db_notifications.insert_one({
+                'origin': worker_id(),
+                'event': event,
+                'at': now_local()
+            })
+        except Exception as e:
+            print(f"Error publishing notification: {e}")
+
+    def _receive(self, doc):
+        if doc.get('origin') != worker_id():
+            self._handler(doc['event'])
+
+    def _listen_loop(self):
+        retry_stream_at = 0
+        while True:
+            if db_notifications is None:
+                time.sleep(NOTIFY_POLL_SECONDS * 4)
+                continue
+            if self.mode == 'mongo:polling' and time.time() < retry_stream_at:
+                self._poll_once()
+                time.sleep(NOTIFY_POLL_SECONDS)
+                continue
+            try:
+                with db_notifications.watch([{'$match': {'operationType': 'insert'}}]) as stream:
+                    self.mode = 'mongo:change_stream'
+                    for change in stream:
+                        self._receive(change['fullDocument'])
+            except Exception as e:
+                if self.mode != 'mongo:polling':
+                    print(f"⚠️ Notification change stream unavailable ({e}) - polling instead")
+                self.mode = 'mongo:polling'
+                retry_stream_at = time.time() + 60
+
+    def _poll_once(self):
+        now = now_local()
+        since = getattr(self, '_poll_since', now)
+        try:
+            # نافذة تداخل ثانيتين لأن ساعات الـ workers قد تختلف قليلاً
+            docs = list(db_notifications.find({'at': {'$gte': since - timedelta(seconds=2)}}).sort('at', 1))
+        except Exception as e:
+            print(f"Error polling notifications: {e}")
+            return
+        for doc in docs:
+            if doc['_id'] not in self._seen:
+                self._seen[doc['_id']] = now
+                self._receive(doc)
+        self._poll_since = now
+        cutoff = now - timedelta(seconds=10)
+        self._seen = {k: t for k, t in self._seen.items() if t >= cutoff}
+
+backplane = MongoBackplane() if NOTIFY_BACKPLANE == 'mongo' else LocalBackplane()
+manager = ConnectionManager(backplane)
+
+# Start idle connection reaper
+threading.Thread(target=manager.reap_loop, daemon=True).start()
 
 # ═══════════════════════════════════════════════════════════════════════════
 # 🤖 System Prompt
@@ -492,96 +2563,720 @@ SYSTEM_PROMPT = """# وكيل طلبات مطعم ملك الطابون
 - في حال طلب "معجنات مناسبات" أخبره أن يتواصل معنا عبر الواتساب 0523668131"""
 
 # ═══════════════════════════════════════════════════════════════════════════
-# 🧹 تنظيف تلقائي (Thread)
+# 🧩 تجميع البرومبت (Prefix ثابت + ميزانية توكنز للتاريخ)
 # ═══════════════════════════════════════════════════════════════════════════
 
-def auto_cleanup():
-    if db_orders is None:
-        return
-        
-    today = datetime.now().strftime('%Y-%m-%d')
-    # تحقق من التنظيف مرة واحدة يومياً
-    if getattr(db, 'last_cleanup', '') != today:
+# الترتيب ثابت حتى يستفيد OpenAI من Prompt Caching:
+# SYSTEM_PROMPT (نفسه لكل الزبائن) ← ذاكرة الزبون (ثابتة طوال المحادثة) ← التاريخ ← الرسالة الجديدة
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('CHAT_HISTORY_TOKEN_BUDGET', 1200))
+CHAT_HISTORY_TRIM_STEP = int(os.getenv('CHAT_HISTORY_TRIM_STEP', 6))  # نقص التاريخ بالجملة وليس رسالة رسالة
+CHAT_SUMMARY_MAX_CHARS = 300
+
+def estimate_tokens(text):
+    """تقدير سريع لعدد التوكنز بدون tokenizer: العربي أغلى من الإنجليزي"""
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    return int((len(text) - non_ascii) / 4 + non_ascii / 2.5) + 1
+
+def customer_memory_prompt(customer):
+    """ذاكرة الزبون كرسالة system - نفس النص لنفس الزبون في كل رسالة"""
+    return (
+        "[SYSTEM MEMORY INJECTION]\n"
+        "⚠️ URGENT INSTRUCTION FOR AI:\n"
+        "The user sending the next message is ALREADY KNOWN.\n"
+        f"- Name: {customer.get('name', 'Unknown')}\n"
+        f"- Phone: {customer.get('phone', 'Unknown')}\n"
+        f"- Preferred Order: {customer.get('orderType', 'Unknown')}\n"
+        f"- Car: {customer.get('carColor', 'Unknown')}\n"
+        f"- Address: {customer.get('address', 'Unknown')}\n"
+        f"- Location: {customer.get('locationName', 'Unknown')}\n"
+        "\n"
+        "DO NOT ask for their name. Greet them by name immediately!\n"
+        f"Example: \"أهلاً {customer.get('name')}! شو حابب تطلب اليوم؟\""
+    )
+
+def compact_history(history, budget=CHAT_HISTORY_TOKEN_BUDGET, step=CHAT_HISTORY_TRIM_STEP):
+    """
+    يرجع (رسائل التاريخ المحتفظ بها، ملخص المحذوف أو None).
+    نقطة القص تتحرك بخطوات ثابتة، فيبقى أول المحادثة نفسه لعدة رسائل متتالية (cache hit).
+    آخر رسالتين (آخر سؤال وجواب) تبقى دائماً حتى لو تجاوزت الميزانية - "اه" بدونها بلا معنى.
+    """
+    turns = [
+        {
+            "role": "user" if msg.get('role') == "user" else "assistant",
+            "content": msg.get('content') or ''
+        }
+        for msg in history
+    ]
+    costs = [estimate_tokens(t['content']) + 4 for t in turns]
+    remaining = sum(costs)
+    cut = 0
+    max_cut = max(len(turns) - 2, 0)
+    while remaining > budget and cut < max_cut:
+        nxt = min(cut + step, max_cut)
+        remaining -= sum(costs[cut:nxt])
+        cut = nxt
+    if cut == 0:
+        return turns, None
+    # ملخص بدون استدعاء AI: طلبات الزبون السابقة بشكل مختصر
+    asked = [t['content'].strip().replace('\n', ' ')[:80] for t in turns[:cut] if t['role'] == 'user']
+    summary = f"[Earlier conversation trimmed: {cut} messages. Customer said: " + " | ".join(asked)
+    summary = summary[:CHAT_SUMMARY_MAX_CHARS] + "]"
+    return turns[cut:], summary
+
+def assemble_prompt(customer, history, message):
+    """رسائل OpenAI النهائية بترتيب ثابت يناسب الـ Prompt Caching"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if customer:
+        messages.append({"role": "system", "content": customer_memory_prompt(customer)})
+    turns, summary = compact_history(history)
+    if summary:
+        messages.append({"role": "system", "content": summary})
+    messages.extend(turns)
+    messages.append({"role": "user", "content": message})
+    return messages
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📋 كتالوج القائمة + ردود سريعة بدون AI
+# ═══════════════════════════════════════════════════════════════════════════
+
+# القائمة والأسعار والردود الثابتة تُقرأ من SYSTEM_PROMPT نفسه، فيبقى مصدر واحد للأسعار
+# رسوم التوصيل كما هي مكتوبة في البرومبت (قسم "خاص لطلبيات التوصيل")
+DELIVERY_FEES = {'العيزرية': 15, 'السواحرة': 20}
+
+_ARABIC_DIACRITICS = re.compile(r'[\u064B-\u0652\u0670\u0640]')
+_ARABIC_LETTER_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه', 'ى': 'ي', 'ؤ': 'و', 'ئ': 'ي',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+    '،': ' ', '؟': ' ', '؛': ' ', '×': 'x'
+})
+
+def normalize_arabic(text):
+    """توحيد الكتابة: بدون تشكيل، ا/أ/إ/آ → ا، ة → ه، ى → ي، أرقام هندية → عربية"""
+    text = _ARABIC_DIACRITICS.sub('', (text or '').lower()).translate(_ARABIC_LETTER_MAP)
+    text = re.sub(r'[^\w\s.]', ' ', text)
+    return ' '.join(text.split())
+
+def normalize_tokens(text):
+    """كلمات موحدة بدون "ال" التعريف (البيتزا = بيتزا)"""
+    return [w[2:] if w.startswith('ال') and len(w) > 4 else w for w in normalize_arabic(text).split()]
+
+def parse_menu(prompt):
+    """أصناف "## القائمة الكاملة" كقائمة {name, price, category}"""
+    section = prompt.split('## القائمة الكاملة', 1)[-1].split('\n## ', 1)[0]
+    items = []
+    category = ''
+    for line in section.splitlines():
+        line = line.strip()
+        if line.startswith('### '):
+            category = line[4:].strip()
+            continue
+        match = re.match(r'^- (.+?):\s*([\d.]+)\s*شيكل', line)
+        if match:
+            items.append({'name': match.group(1).strip(), 'price': float(match.group(2)), 'category': category})
+    return items
+
+def parse_prompt_facts(prompt):
+    """سطور "- المفتاح: القيمة" من أقسام المعلومات والردود الخاصة"""
+    facts = {}
+    for title in ('## معلومات المطعم', '## الردود الخاصة'):
+        section = prompt.split(title, 1)[-1].split('\n## ', 1)[0]
+        for line in section.splitlines():
+            match = re.match(r'^- ([^:]+):\s*"?(.+?)"?$', line.strip())
+            if match:
+                facts[match.group(1).strip()] = match.group(2).strip()
+    return facts
+
+MENU_ITEMS = parse_menu(SYSTEM_PROMPT)
+PROMPT_FACTS = parse_prompt_facts(SYSTEM_PROMPT)
+for _item in MENU_ITEMS:
+    _item['tokens'] = tuple(normalize_tokens(_item['name']))
+MENU_VOCABULARY = sorted({tok for _item in MENU_ITEMS for tok in _item['tokens']})
+_MENU_VOCABULARY_SET = frozenset(MENU_VOCABULARY)
+
+# كلمات النية (بعد التوحيد)
+_ORDER_WORDS = {'بدي', 'بدنا', 'بدو', 'اطلب', 'بطلب', 'ابغي', 'اعطيني', 'عطيني', 'جيبلي', 'سجل', 'سجلي', 'ضيف', 'زيد', 'اكد', 'تاكيد', 'order'}
+_PRICE_WORDS = {'بكم', 'كم', 'قديش', 'بقديش', 'سعر', 'اسعار', 'حق', 'price', 'cost', 'much'}
+_HOURS_WORDS = {'ساعات', 'دوام', 'فاتحين', 'مفتوحين', 'بتفتحو', 'بتفتحوا', 'تفتحو', 'بتسكرو', 'بتسكروا', 'بتسكر', 'open', 'hours', 'close'}
+_DELIVERY_WORDS = {'توصيل', 'بتوصلو', 'بتوصلوا', 'توصلو', 'توصلوا', 'دليفري', 'delivery', 'deliver'}
+_PAYMENT_WORDS = {'دفع', 'فيزا', 'كاش', 'بطاقه', 'visa', 'card', 'pay', 'payment'}
+_ADDRESS_WORDS = {'وين', 'عنوان', 'عنوانكم', 'موقع', 'موقعكم', 'مكانكم', 'where', 'address', 'location'}
+# كلمة واحدة مثل "توصيل" أو "كاش" غالباً جواب لسؤال الـ AI وليست سؤالاً - نطلب صيغة سؤال
+_QUESTION_WORDS = {'هل', 'شو', 'ايش', 'وين', 'متي', 'امتي', 'ايمتي', 'كيف', 'كم', 'بكم', 'قديش', 'بقديش', 'عندكم',
+                   'بتقبلو', 'بتقبلوا', 'بتوصلو', 'بتوصلوا', 'بتفتحو', 'بتفتحوا', 'بتسكرو', 'بتسكروا',
+                   'what', 'when', 'where', 'how', 'do', 'does', 'is', 'are', 'can'}
+# سؤال عن طلب الزبون نفسه ("وين طلبي؟") - للـ AI وليس للعنوان
+_MY_ORDER_WORDS = {'طلب', 'طلبي', 'طلبيه', 'طلبيتي', 'طلبنا', 'طلبيتنا'}
+ORDER_NUMBER_MARKER = 'رقم طلبك'
+QUICK_REPLY_MAX_WORDS = 12
+# التسامح الإملائي فقط لكلمة طويلة وقريبة جداً - "بدها" لا تصبح "كبده"
+MENU_FUZZY_CUTOFF = 0.85
+MENU_FUZZY_MIN_LENGTH = 4
+_FUNCTION_WORDS = (_ORDER_WORDS | _PRICE_WORDS | _QUESTION_WORDS | _MY_ORDER_WORDS |
+                   {'بدها', 'بده', 'بدك', 'وقت', 'لسا', 'لسه', 'هلا', 'هسا', 'شي', 'في', 'على', 'مع', 'عن', 'الي', 'اللي'})
+
+@lru_cache(maxsize=4096)
+def _menu_token(token):
+    """أقرب كلمة من كلمات القائمة (تسامح مع الأخطاء الإملائية) أو None"""
+    if token in _MENU_VOCABULARY_SET:
+        return token
+    if token.startswith('و') and token[1:] in _MENU_VOCABULARY_SET:
+        # "وماء" = "و" + "ماء"
+        return token[1:]
+    if len(token) < MENU_FUZZY_MIN_LENGTH or token in _FUNCTION_WORDS:
+        return None
+    close = difflib.get_close_matches(token, MENU_VOCABULARY, n=1, cutoff=MENU_FUZZY_CUTOFF)
+    return close[0] if close else None
+
+def match_menu_items(tokens):
+    """الأصناف التي كل كلماتها موجودة بالرسالة - الأكثر تحديداً أولاً"""
+    found = {_menu_token(tok) for tok in tokens} - {None}
+    matches = [item for item in MENU_ITEMS if found.issuperset(item['tokens'])]
+    matches.sort(key=lambda item: len(item['tokens']), reverse=True)
+    return matches, found
+
+def format_price(price):
+    return f"{price:g}"
+
+def order_in_progress(history):
+    """
+    هل الزبون في منتصف محادثة طلب مع الـ AI؟ - يوجد رد من الـ AI (وليس رداً سريعاً)
+    بعد آخر طلب اكتمل، فالرسالة التالية غالباً جواب له ("توصيل"، "كاش").
+    """
+    in_progress = False
+    previous_user = None
+    for turn in history if isinstance(history, list) else []:
+        if not isinstance(turn, dict):
+            continue
+        content = (turn.get('content') or '').strip()
+        if turn.get('role') == 'user':
+            previous_user = content
+        elif ORDER_NUMBER_MARKER in content:
+            in_progress = False
+        elif previous_user is None or catalog_reply(previous_user) != content:
+            in_progress = True
+    return in_progress
+
+def quick_reply(message, history=None):
+    """
+    رد فوري للأسئلة المتكررة (سعر صنف، الدوام، التوصيل، الدفع، العنوان) من الكتالوج.
+    يرجع None لأي شيء يشبه طلباً فعلياً، أو إذا كان الزبون في منتصف طلب - هذا يبقى للـ AI.
+    """
+    if order_in_progress(history):
+        return None
+    return catalog_reply(message)
+
+def catalog_reply(message):
+    """الرد من الكتالوج للرسالة وحدها (بدون النظر للمحادثة) أو None"""
+    tokens = normalize_tokens(message)
+    if not tokens or len(tokens) > QUICK_REPLY_MAX_WORDS:
+        return None
+    words = set(tokens)
+    if words & (_ORDER_WORDS | _MY_ORDER_WORDS):
+        return None
+
+    if words & _PRICE_WORDS:
+        matches, found = match_menu_items(tokens)
+        if matches:
+            item = matches[0]
+            return f"{item['name']} بـ {format_price(item['price'])} شيكل 😋 بتحب أسجللك ياه؟"
+        # سؤال عن نوع (مثلاً "بكم البيتزا") - نعرض خيارات هذا النوع فقط
+        options = [item for item in MENU_ITEMS if item['tokens'][0] in found]
+        if options:
+            lines = [f"- {item['name']}: {format_price(item['price'])} شيكل" for item in options]
+            return "الأسعار:\n" + "\n".join(lines) + "\nشو بتحب تطلب؟"
+        return None
+
+    if not ('?' in message or '؟' in message or words & _QUESTION_WORDS):
+        return None
+
+    if words & _HOURS_WORDS:
+        return PROMPT_FACTS.get('ساعات العمل')
+
+    if words & _DELIVERY_WORDS:
+        reply = PROMPT_FACTS.get('التوصيل')
+        for area, fee in DELIVERY_FEES.items():
+            if normalize_arabic(area) in normalize_arabic(message):
+                return f"{reply} 🚗 التوصيل على {area} بـ {fee} شيكل"
+        return reply
+
+    if words & _PAYMENT_WORDS:
+        return PROMPT_FACTS.get('الدفع')
+
+    if words & _ADDRESS_WORDS:
+        address = PROMPT_FACTS.get('العنوان')
+        return f"📍 {address}" if address else None
+
+    return None
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 💰 محرك التسعير (حساب المجموع في السيرفر بدل الثقة بالـ AI)
+# ═══════════════════════════════════════════════════════════════════════════
+
+_QUANTITY_WORDS = {
+    'واحد': 1, 'وحده': 1, 'حبه': 1,
+    'اثنين': 2, 'اتنين': 2, 'ثنتين': 2, 'تنتين': 2, 'حبتين': 2, 'زوج': 2,
+    'ثلاث': 3, 'ثلاثه': 3, 'تلات': 3, 'تلاته': 3,
+    'اربع': 4, 'اربعه': 4, 'خمس': 5, 'خمسه': 5
+}
+# كلمات مسموح تكون حول الصنف بدون ما تغير السعر
+_ITEM_FILLER_WORDS = {'مع', 'و', 'من', 'حبات', 'حبه', 'قطع', 'قطعه', 'كمان', 'بس', 'فقط', 'عدد', 'شيكل', 'x'}
+_ITEM_SEPARATORS = re.compile(r'[،,+\n;؛]|\s+و\s+')
+
+class MenuTrie:
+    """Trie على كلمات أسماء الأصناف (بعد التوحيد) - أطول تطابق يفوز: "بيتزا عيمك ستيك" قبل "بيتزا"""
+
+    def __init__(self, items):
+        self.root = {}
+        for item in items:
+            node = self.root
+            for tok in item['tokens']:
+                node = node.setdefault(tok, {})
+            node['$'] = item
+
+    def longest_match(self, tokens, start):
+        """يرجع (الصنف، موقع نهاية التطابق) أو (None, start)"""
+        node = self.root
+        best = (None, start)
+        for i in range(start, len(tokens)):
+            node = node.get(tokens[i])
+            if node is None:
+                break
+            if '$' in node:
+                best = (node['$'], i + 1)
+        return best
+
+MENU_TRIE = MenuTrie(MENU_ITEMS)
+
+def _parse_quantity(token):
+    """(الكمية، هل هي مؤكدة بعلامة x أو ككلمة عدد) أو (None, False)"""
+    if token in _QUANTITY_WORDS:
+        return _QUANTITY_WORDS[token], True
+    match = re.fullmatch(r'(x?)(\d{1,2})(x?)', token)
+    if not match:
+        return None, False
+    return int(match.group(2)), bool(match.group(1) or match.group(3))
+
+def _join_quantity_marks(tokens):
+    # "x 2" و "2 x" (بعد توحيد × إلى x) تصبح كلمة واحدة "x2" / "2x"
+    joined = []
+    for tok in tokens:
+        if joined and ((joined[-1] == 'x' and tok.isdigit()) or (joined[-1].isdigit() and tok == 'x')):
+            joined[-1] += tok
+        else:
+            joined.append(tok)
+    return joined
+
+def items_text(items):
+    """الأصناف كما أرسلها العميل أو الـ AI (نص، قائمة، أو {name, qty}) -> نص واحد للتسعير"""
+    if items is None:
+        return ''
+    if isinstance(items, str):
+        return items
+    if isinstance(items, (list, tuple)):
+        return '، '.join(items_text(item) for item in items)
+    if isinstance(items, dict) and items.get('name'):
+        qty = items.get('qty') or items.get('quantity')
+        return f"{qty} {items['name']}" if qty else str(items['name'])
+    return str(items)
+
+def parse_order_items(items):
+    """
+    يحول الأصناف ("2 بيتزا تونا، ماء صغير" أو قائمة) لسطور {name, price, qty}.
+    يرجع (السطور، الأجزاء التي لم نتعرف عليها).
+    الرقم كمية فقط قبل الصنف أو مع x/× بعده - "بيتزا تونا 25" قد يكون سعراً فلا نخمن.
+    """
+    lines = []
+    unmatched = []
+    for segment in _ITEM_SEPARATORS.split(items_text(items)):
+        raw_tokens = _join_quantity_marks(normalize_tokens(segment))
+        if not raw_tokens:
+            continue
+        tokens = [_menu_token(tok) or tok for tok in raw_tokens]
+        found = []          # [line, ...] بنفس ترتيب الظهور
+        unknown = []
+        pending_qty = None
+        i = 0
+        while i < len(tokens):
+            item, end = MENU_TRIE.longest_match(tokens, i)
+            if item is not None:
+                line = {'name': item['name'], 'price': item['price'], 'qty': pending_qty or 1, 'explicitQty': pending_qty is not None}
+                found.append(line)
+                pending_qty = None
+                i = end
+                continue
+            qty, marked = _parse_quantity(raw_tokens[i])
+            if qty is not None:
+                if marked and found and not found[-1]['explicitQty'] and pending_qty is None:
+                    # الكمية بعد الصنف ("بيتزا تونا ×2")
+                    found[-1]['qty'] = qty
+                    found[-1]['explicitQty'] = True
+                elif pending_qty is None:
+                    pending_qty = qty
+                else:
+                    unknown.append(raw_tokens[i])
+            elif tokens[i] not in _ITEM_FILLER_WORDS:
+                unknown.append(raw_tokens[i])
+            i += 1
+        if pending_qty is not None:
+            # رقم بدون صنف بعده - لا نعرف إن كان كمية أو سعراً
+            unknown.append(str(pending_qty))
+        if not found or unknown:
+            # كلمة مش من القائمة (مثلاً "كولا") - ما منقدر نضمن السعر
+            unmatched.append(segment.strip())
+        for line in found:
+            del line['explicitQty']
+            lines.append(line)
+    return lines, unmatched
+
+def delivery_fee(order_type, *places):
+    """رسوم التوصيل حسب المنطقة - 0 لغير التوصيل، None إذا المنطقة غير معروفة"""
+    if order_type != 'delivery':
+        return 0
+    text = normalize_arabic(' '.join(p for p in places if p))
+    for area, fee in DELIVERY_FEES.items():
+        if normalize_arabic(area) in text:
+            return fee
+    return None
+
+def price_order(items, order_type='dine_in', location='', address=''):
+    """تسعير كامل للطلب من القائمة - verified=False إذا لم نتعرف على كل شيء"""
+    lines, unmatched = parse_order_items(items)
+    subtotal = sum(line['price'] * line['qty'] for line in lines)
+    fee = delivery_fee(order_type, location, address)
+    verified = bool(lines) and not unmatched and fee is not None
+    return {
+        'lines': lines,
+        'unmatched': unmatched,
+        'subtotal': subtotal,
+        'deliveryFee': fee,
+        'total': subtotal + (fee or 0),
+        'verified': verified
+    }
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📊 أرشيف المبيعات (Rollups) - ملخصات يومية وساعية تبقى بعد المسح اليومي
+# ═══════════════════════════════════════════════════════════════════════════
+
+ROLLUP_BUCKETS = ('day', 'hour')
+ANALYTICS_MAX_DAYS = 90
+
+def _rollup_time(order):
+    """وقت الطلب للملخص (createdAt وإلا updatedAt) أو None - نص قديم لا يُقرأ لا يوقف التلخيص"""
+    for field in ('createdAt', 'updatedAt'):
+        value = order.get(field)
+        if isinstance(value, str):
+            try:
+                value = parse_legacy_timestamp(value)
+            except ValueError:
+                continue
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                value = pytz.utc.localize(value)
+            return value.astimezone(LOCAL_TZ)
+    return None
+
+def _rollup_keys(at):
+    """(_id, kind, بداية الفترة) لكل ملخص يدخل فيه الطلب"""
+    day = LOCAL_TZ.localize(datetime(at.year, at.month, at.day))
+    hour = LOCAL_TZ.localize(datetime(at.year, at.month, at.day, at.hour))
+    return [
+        (f"day:{at:%Y-%m-%d}", 'day', day),
+        (f"hour:{at:%Y-%m-%dT%H}", 'hour', hour)
+    ]
+
+def _rollup_field(name):
+    # أسماء الأصناف تصبح مفاتيح في MongoDB - بدون . أو $
+    return str(name).replace('.', '_').replace('$', '_')
+
+def rollup_orders(query):
+    """
+    يلخص الطلبات المطابقة في order_rollups قبل حذفها، ويرجع فلتر الطلبات التي لُخصت
+    (احذف بهذا الفلتر حتى لا يُحذف طلب وصل بعد التلخيص).
+    كل تشغيل يعلّم طلباته بـ rolledUp=batch، وكل ملخص يحفظ الـ batches التي دخلت فيه،
+    فإعادة التشغيل بعد انقطاع لا تعدّ نفس الطلب مرتين.
+    """
+    if db_rollups is None:
+        return query
+    done = {**query, 'rolledUp': {'$exists': True}}
+    batch = f"{worker_id()}:{time.time_ns()}"
+    db_orders.update_many({**query, 'rolledUp': {'$exists': False}}, {'$set': {'rolledUp': batch}})
+
+    totals = {}   # {(batch, _id): {...}}
+    undated = 0
+    projection = {'rolledUp': 1, 'createdAt': 1, 'updatedAt': 1, 'status': 1, 'orderType': 1, 'total': 1, 'items': 1}
+    for order in db_orders.find(done, projection=projection):
+        at = _rollup_time(order)
+        if at is None:
+            undated += 1
+            continue
         try:
-            yesterday = datetime.now() - timedelta(days=1)
-            yesterday = yesterday.replace(hour=0, minute=0, second=0, microsecond=0)
-            yesterday_iso = yesterday.isoformat()
-            
-            # حذف الطلبات الأقدم من الأمس
-            result = db_orders.delete_many({
-                'createdAt': {'$lt': yesterday_iso}
-            })
-            
-            if result.deleted_count > 0:
-                print(f"🧹 تنظيف تلقائي: تم حذف {result.deleted_count} طلب قديم من MongoDB")
-            
-            db.last_cleanup = today
+            lines, unmatched = parse_order_items(order.get('items', ''))
         except Exception as e:
-            print(f"Error in auto_cleanup: {e}")
+            # أصناف بشكل غير متوقع - الطلب يُعد بدون تفصيل الأصناف
+            print(f"⚠️ Rollup: items of order #{order['_id']} not parsed ({e})")
+            lines, unmatched = [], [order.get('items')]
+        for key, kind, start in _rollup_keys(at):
+            entry = totals.setdefault((order['rolledUp'], key), {'kind': kind, 'date': start, 'inc': {}})
+            inc = entry['inc']
+            inc['orders'] = inc.get('orders', 0) + 1
+            if order.get('status') == 'delivered' and isinstance(order.get('total'), (int, float)):
+                inc['revenue'] = inc.get('revenue', 0) + order['total']
+            for field in (f"byStatus.{order.get('status')}", f"byType.{order.get('orderType')}"):
+                inc[field] = inc.get(field, 0) + 1
+            for line in lines:
+                field = f"items.{_rollup_field(line['name'])}"
+                inc[field] = inc.get(field, 0) + line['qty']
+            if unmatched:
+                inc['unmatchedItems'] = inc.get('unmatchedItems', 0) + len(unmatched)
 
-def daily_cleanup_loop():
-    last_cleanup_date = ""
-    while True:
+    ops = [
+        UpdateOp(
+            {'_id': key, 'batches': {'$ne': order_batch}},
+            {
+                '$inc': entry['inc'],
+                '$set': {'kind': entry['kind'], 'date': entry['date']},
+                '$push': {'batches': order_batch}
+            },
+            upsert=True
+        )
+        for (order_batch, key), entry in totals.items()
+    ]
+    if ops:
         try:
-            jerusalem_tz = pytz.timezone('Asia/Jerusalem')
-            now = datetime.now(jerusalem_tz)
-            
-            hours = now.hour
-            minutes = now.minute
-            today_date = now.strftime('%Y-%m-%d')
-            
-            # الساعة 5 فجراً
-            if hours == 5 and minutes < 2 and last_cleanup_date != today_date:
-                if db_orders is not None:
-                    # حذف جميع الطلبات (تصفير يومي)
-                    result = db_orders.delete_many({})
-                    deleted_count = result.deleted_count
-                    
-                    # إعادة تعيين العداد (اختياري، لكن يفضل الحفاظ على التسلسل)
-                    # db.counter = 1000 
-                    
-                    last_cleanup_date = today_date
-                    print(f'\n🧹 مسح يومي (5:00 فجراً) - تم حذف {deleted_count} طلب من MongoDB\n')
-        except Exception as e:
-            print(f"Error in cleanup loop: {e}")
-        time.sleep(30)
+            db_rollups.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # 11000 = الملخص فيه هذا الـ batch مسبقاً (upsert اصطدم بالـ _id) - هذا المطلوب
+            if non_duplicate_errors(e):
+                raise
+    print(f"📊 Rolled up {len(ops)} summary updates before delete"
+          + (f" ({undated} orders without a readable date skipped)" if undated else ""))
+    return done
 
-# Start cleanup thread
-threading.Thread(target=daily_cleanup_loop, daemon=True).start()
+def sales_history(days=30, kind='day'):
+    """الملخصات لآخر days يوم بالترتيب - range scan على (kind, date)"""
+    if db_rollups is None:
+        return []
+    return list(db_rollups.find(
+        {'kind': kind, 'date': {'$gte': local_midnight(days_ago=days - 1)}},
+        projection={'batches': 0}
+    ).sort('date', 1))
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🧹 تنظيف تلقائي (Thread)
+# ═══════════════════════════════════════════════════════════════════════════
+
+RETENTION_HOUR = 5                 # التصفير اليومي الساعة 5 فجراً بتوقيت المطعم
+RETENTION_BATCH = int(os.getenv('RETENTION_BATCH', 500))
+RETENTION_BATCH_PAUSE = 0.05       # استراحة بين الدفعات حتى لا تتأخر قراءات الشاشات
+RETENTION_LEASE_SECONDS = 600
+ARCHIVE_TTL_DAYS = int(os.getenv('ARCHIVE_TTL_DAYS', 90))
+
+class RetentionJob:
+    """
+    أرشفة ثم حذف الطلبات القديمة خارج مسار الطلبات:
+    يحسب موعد التشغيل التالي وينام حتى يحين، ينقل الطلبات بدفعات إلى orders_archive
+    (مضغوطة zstd وتُحذف بفهرس TTL)، ثم يحذفها من orders.
+    worker واحد فقط يشغله في كل مرة عبر lease في collection locks.
+    """
+
+    def __init__(self, hour=RETENTION_HOUR):
+        self.hour = hour
+        self.last_report = None
+        self._wake = threading.Event()
+
+    def last_due(self, now=None):
+        """آخر موعد تشغيل مستحق (اليوم 5:00 أو أمس)"""
+        now = now or now_local()
+        day = now.date() if now.hour >= self.hour else now.date() - timedelta(days=1)
+        return LOCAL_TZ.localize(datetime(day.year, day.month, day.day, self.hour))
+
+    def next_due(self, now=None):
+        day = self.last_due(now).date() + timedelta(days=1)
+        return LOCAL_TZ.localize(datetime(day.year, day.month, day.day, self.hour))
+
+    def _last_run(self):
+        doc = db_locks.find_one({'_id': 'retention'}, projection={'lastRun': 1}) if db_locks is not None else None
+        return doc.get('lastRun') if doc else None
+
+    def _acquire(self):
+        now = now_local()
+        try:
+            # upsert يصطدم بالـ _id إذا كان lease worker آخر ما زال سارياً
+            db_locks.find_one_and_update(
+                {'_id': 'retention', '$or': [{'until': {'$lt': now}}, {'until': {'$exists': False}}]},
+                {'$set': {'until': now + timedelta(seconds=RETENTION_LEASE_SECONDS), 'owner': worker_id()}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def _release(self, finished_at=None):
+        update = {'until': now_local()}
+        if finished_at is not None:
+            update['lastRun'] = finished_at
+        db_locks.update_one({'_id': 'retention', 'owner': worker_id()}, {'$set': update})
+
+    def _archive_batch(self, ids):
+        """دفعة واحدة: تلخيص -> نسخ للأرشيف -> حذف. يرجع (archived, deleted)"""
+        done = rollup_orders({'_id': {'$in': ids}})
+        docs = list(db_orders.find(done))
+        archived = 0
+        if docs:
+            archived_at = now_local()
+            for doc in docs:
+                doc['archivedAt'] = archived_at
+            try:
+                archived = len(db_archive.insert_many(docs, ordered=False).inserted_ids)
+            except BulkWriteError as e:
+                if non_duplicate_errors(e):
+                    raise
+                archived = e.details.get('nInserted', 0)
+        deleted = db_orders.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}}).deleted_count
+        return archived, deleted
+
+    def run(self, cutoff=None):
+        """
+        ينقل كل طلب أُنشئ قبل cutoff (الافتراضي: الآن = تصفير كامل) - يرجع تقريراً،
+        أو None إذا كان worker آخر يشغله الآن.
+        """
+        if db_orders is None or db_locks is None:
+            return None
+        if not self._acquire():
+            return None
+        started = now_local()
+        cutoff = cutoff or started
+        # $not يشمل التواريخ القديمة المخزنة كنص والطلبات بدون createdAt (مثل التصفير القديم)
+        query = {'createdAt': {'$not': {'$gte': cutoff}}}
+        report = {'startedAt': started, 'cutoff': cutoff, 'batches': 0, 'archived': 0, 'deleted': 0}
+        finished = None
+        try:
+            ensure_collections()
+            while True:
+                ids = [doc['_id'] for doc in db_orders.find(query, projection={'_id': 1}).limit(RETENTION_BATCH)]
+                if not ids:
+                    break
+                archived, deleted = self._archive_batch(ids)
+                report['batches'] += 1
+                report['archived'] += archived
+                report['deleted'] += deleted
+                if deleted == 0:
+                    break   # لا تقدم (مثلاً التلخيص معطل) - لا نعلق في حلقة
+                time.sleep(RETENTION_BATCH_PAUSE)
+            finished = now_local()
+        finally:
+            self._release(finished)
+            report['seconds'] = round((now_local() - started).total_seconds(), 3)
+            self.last_report = report
+            if report['deleted']:
+                db.cache.load()
+                db.log_event('purge', data={'deleted': report['deleted']})
+        print(f"🧹 Retention: archived {report['archived']}, deleted {report['deleted']} "
+              f"in {report['batches']} batches ({report['seconds']}s)")
+        return report
+
+    def trigger(self):
+        self._wake.set()
+
+    def loop(self):
+        while True:
+            try:
+                last_run = self._last_run()
+                due = self.last_due()
+                if db_orders is not None and (last_run is None or last_run < due):
+                    # يشمل موعداً فات والسيرفر مطفأ - cutoff هو الموعد نفسه فلا تُمس طلبات ما بعد 5:00
+                    self.run(cutoff=due)
+            except Exception as e:
+                print(f"Error in retention job: {e}")
+            now = now_local()
+            wait = (self.next_due(now) - now).total_seconds()
+            try:
+                last_run = self._last_run()
+            except Exception:
+                last_run = None
+            if last_run is None or last_run < self.last_due(now):
+                # worker آخر يشغله أو فشل التشغيل - نتأكد مرة أخرى بعد مدة الـ lease
+                wait = min(wait, RETENTION_LEASE_SECONDS)
+            self._wake.wait(wait)
+            self._wake.clear()
+
+retention = RetentionJob()
 
 # ═══════════════════════════════════════════════════════════════════════════
 # 🔌 WebSocket Endpoints
 # ═══════════════════════════════════════════════════════════════════════════
 
-@sock.route('/ws/notifications')
-def websocket_notifications(ws):
-    manager.connect(ws)
+def client_ip():
+    # ProxyFix وضع هنا العنوان الذي أضافه البروكسي الموثوق (لا يمكن للعميل تزويره)
+    return request.remote_addr
+
+def handle_client_message(ws, data):
+    """رسائل {type: ping} أو {type: subscribe/unsubscribe, orderId | topic | orderType}"""
     try:
-        while True:
-            data = ws.receive()
+        msg = json.loads(data)
+    except ValueError:
+        return
+    if not isinstance(msg, dict):
+        return
+    if msg.get('type') == 'ping':
+        # heartbeat من المتصفح (لا يرى ping البروتوكول)
+        manager.reply(ws, {'type': 'pong'})
+        return
+    if msg.get('type') not in ('subscribe', 'unsubscribe'):
+        return
+    if msg.get('orderId'):
+        try:
+            topic = order_topic(int(msg['orderId']))
+        except (TypeError, ValueError):
+            return
+    elif msg.get('orderType'):
+        topic = order_type_topic(msg['orderType'])
+    else:
+        topic = msg.get('topic')
+    if not is_valid_topic(topic):
+        return
+    if msg['type'] == 'subscribe':
+        manager.subscribe(ws, topic)
+    else:
+        manager.unsubscribe(ws, topic)
+
+def serve_socket(ws, order_id=None, topics=()):
+    """حلقة موحدة لكل الـ WebSocket endpoints: حدود الاتصال، الاشتراك، الاستقبال، والتنظيف"""
+    conn = manager.connect(ws, order_id, ip=client_ip())
+    if conn is None:
+        ws.close(reason=1013, message='too many connections')
+        return
+    for topic in topics:
+        manager.subscribe(ws, topic)
+    try:
+        while not conn.closed:
+            # مهلة حتى نلاحظ إغلاق الـ reaper أو الطابور الممتلئ
+            data = ws.receive(timeout=WS_PING_INTERVAL)
             if data:
-                try:
-                    msg = json.loads(data)
-                    if msg.get('type') == 'subscribe' and msg.get('orderId'):
-                        order_id = int(msg['orderId'])
-                        manager.connect(ws, order_id) # Register for order specific updates
-                except:
-                    pass
+                manager.touch(ws)
+                handle_client_message(ws, data)
     except Exception:
         pass
     finally:
         manager.disconnect(ws)
 
+@sock.route('/ws/notifications')
+def websocket_notifications(ws):
+    serve_socket(ws)
+
+@sock.route('/ws/staff')
+def websocket_staff_notifications(ws):
+    """شاشة العمال: كل الطلبات، أو نوع واحد عبر ?orderType=delivery"""
+    order_type = request.args.get('orderType')
+    serve_socket(ws, topics=[order_type_topic(order_type) if order_type in ORDER_TYPES else STAFF_TOPIC])
+
 @sock.route('/ws/notifications/<int:order_id>')
 def websocket_order_notifications(ws, order_id):
-    manager.connect(ws, order_id)
-    try:
-        while True:
-            ws.receive()
-    except Exception:
-        pass
-    finally:
-        manager.disconnect(ws, order_id)
+    serve_socket(ws, order_id)
 
 # ═══════════════════════════════════════════════════════════════════════════
 # 🔌 API Endpoints
@@ -612,12 +3307,8 @@ def identify_customer():
             "found": False
         })
 
-@app.route('/api/chat', methods=['POST'])
-def chat_endpoint():
-    data = request.json
-    if not data or 'message' not in data:
-        return jsonify({"success": False, "error": "الرسالة مطلوبة"}), 400
-
+def build_chat_messages(data):
+    """بناء المحادثة للـ AI: البرومبت + ذاكرة الزبون + التاريخ + الرسالة الجديدة"""
     message = data['message']
     history = data.get('history', [])
     fingerprint = data.get('fingerprint')
@@ -637,120 +3328,129 @@ def chat_endpoint():
     if mongo_customer_data:
         final_customer_data.update(mongo_customer_data)
 
-    # بناء المحادثة
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-
     # ✅ إضافة بيانات الزبون للـ AI
     if final_customer_data:
         print(f"👤 Found customer data for AI: {final_customer_data.get('name')}")
+    
+    return assemble_prompt(final_customer_data, history, message)
+
+def create_order_from_chat(raw_block, fingerprint):
+    """تحويل محتوى بلوك ORDER_DATA لطلب محفوظ - يرجع رقم الطلب أو None"""
+    try:
+        # Clean up markdown code blocks if present
+        raw_json = raw_block.strip()
+        if raw_json.startswith('```json'):
+            raw_json = raw_json[7:]
+        if raw_json.startswith('```'):
+            raw_json = raw_json[3:]
+        if raw_json.endswith('```'):
+            raw_json = raw_json[:-3]
         
-        system_injection = f"""
-        [SYSTEM MEMORY INJECTION]
-        ⚠️ URGENT INSTRUCTION FOR AI:
-        The user sending the next message is ALREADY KNOWN.
-        - Name: {final_customer_data.get('name', 'Unknown')}
-        - Phone: {final_customer_data.get('phone', 'Unknown')}
-        - Preferred Order: {final_customer_data.get('orderType', 'Unknown')}
-        - Car: {final_customer_data.get('carColor', 'Unknown')}
-        - Address: {final_customer_data.get('address', 'Unknown')}
-        - Location: {final_customer_data.get('locationName', 'Unknown')}
+        order_data = json.loads(raw_json.strip())
+        print(f"📦 Extracted order data: {order_data}")
         
-        DO NOT ask for their name. Greet them by name immediately!
-        Example: "أهلاً {final_customer_data.get('name')}! شو حابب تطلب اليوم؟"
-        """
-        messages.append({"role": "system", "content": system_injection})
-    
-    # إضافة التاريخ (آخر 10 رسائل)
-    for msg in history[-10:]:
-        messages.append({
-            "role": "user" if msg.get('role') == "user" else "assistant",
-            "content": msg.get('content')
+        # ✅ حفظ بيانات الزبون
+        if fingerprint:
+            print(f"💾 Saving customer data for {fingerprint}...")
+            save_customer_data(fingerprint, {
+                'name': order_data.get('customer'),
+                'phone': order_data.get('phone'),
+                'orderType': order_data.get('orderType'),
+                'carColor': order_data.get('carInfo'),
+                'address': order_data.get('address'),
+                'locationName': order_data.get('location')
+            })
+        else:
+            print("⚠️ No fingerprint provided, skipping customer save")
+        
+        # 💰 المجموع يُحسب من القائمة، ومجموع الـ AI يُستخدم فقط إذا لم نقدر نتحقق
+        try:
+            ai_total = float(order_data.get('total', 0) or 0)
+        except (TypeError, ValueError):
+            ai_total = 0
+        try:
+            pricing = price_order(
+                order_data.get('items', ''),
+                order_data.get('orderType', 'dine_in'),
+                order_data.get('location', ''),
+                order_data.get('address', '')
+            )
+        except Exception as e:
+            # التسعير لا يجوز أن يُضيع الطلب - نحفظه بمجموع الـ AI (غير مؤكد)
+            print(f"⚠️ Pricing failed ({e}) - using AI total")
+            pricing = {'lines': [], 'deliveryFee': None, 'total': ai_total, 'verified': False}
+        total = pricing['total'] if pricing['verified'] else ai_total
+        if pricing['verified'] and abs(pricing['total'] - ai_total) > 0.01:
+            print(f"⚠️ AI total {ai_total} != menu total {pricing['total']} - using menu total")
+        
+        order = {
+            'id': db.next_order_id(),
+            'customerName': order_data.get('customer', 'عميل'),
+            'phone': order_data.get('phone', ''),
+            'items': order_data.get('items', ''),
+            'total': total,
+            'pricing': {
+                'verified': pricing['verified'],
+                'lines': pricing['lines'],
+                'deliveryFee': pricing['deliveryFee'],
+                'aiTotal': ai_total
+            },
+            'orderType': order_data.get('orderType', 'dine_in'),
+            'location': order_data.get('location', 'غير محدد'),
+            'address': order_data.get('address', ''),
+            'carInfo': order_data.get('carInfo', ''),
+            'deliveryNotes': order_data.get('deliveryNotes', ''),
+            'status': 'new',
+            'createdAt': now_local(),
+            'updatedAt': now_local(),
+            'source': 'AI_Chat',
+            'fingerprint': fingerprint  # ✅ حفظ البصمة
+        }
+        
+        # ✅ استخدام الطريقة الجديدة للإضافة
+        db.add_order(order)
+        print(f"🔔 طلب جديد من AI #{order['id']}: {order['customerName']}")
+        return order['id']
+
+    except OrderNotSavedError:
+        raise
+    except Exception as e:
+        print(f"Error parsing order: {e}")
+        return None
+
+@app.route('/api/chat', methods=['POST'])
+def chat_endpoint():
+    data = request.json
+    if not data or 'message' not in data:
+        return jsonify({"success": False, "error": "الرسالة مطلوبة"}), 400
+
+    # ⚡ أسئلة الأسعار/الدوام/التوصيل تُجاب مباشرة بدون AI
+    fast_reply = quick_reply(data['message'], data.get('history'))
+    if fast_reply:
+        return jsonify({
+            "success": True,
+            "reply": fast_reply,
+            "orderId": None,
+            "fastPath": True
         })
-    
-    messages.append({"role": "user", "content": message})
+
+    fingerprint = data.get('fingerprint')
+    messages = build_chat_messages(data)
 
     try:
         # استدعاء OpenAI API مباشرة بدون SDK لتجنب مشاكل Pydantic
-        headers = {
-            "Authorization": f"Bearer {OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": "gpt-4o-mini",
-            "messages": messages,
-            "max_tokens": 500,
-            "temperature": 0.7
-        }
-        
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        response.raise_for_status()
-        
-        ai_response = response.json()
-        reply = ai_response['choices'][0]['message']['content']
+        reply = llm.chat(messages)
 
         # استخراج بيانات الطلب
         order_match = re.search(r'\[ORDER_DATA\](.*?)\[/ORDER_DATA\]', reply, re.DOTALL)
         order_id = None
         
         if order_match:
-            try:
-                # Clean up markdown code blocks if present
-                raw_json = order_match.group(1).strip()
-                if raw_json.startswith('```json'):
-                    raw_json = raw_json[7:]
-                if raw_json.startswith('```'):
-                    raw_json = raw_json[3:]
-                if raw_json.endswith('```'):
-                    raw_json = raw_json[:-3]
-                
-                order_data = json.loads(raw_json.strip())
-                print(f"📦 Extracted order data: {order_data}")
-                
-                # ✅ حفظ بيانات الزبون
-                if fingerprint:
-                    print(f"💾 Saving customer data for {fingerprint}...")
-                    save_customer_data(fingerprint, {
-                        'name': order_data.get('customer'),
-                        'phone': order_data.get('phone'),
-                        'orderType': order_data.get('orderType'),
-                        'carColor': order_data.get('carInfo'),
-                        'address': order_data.get('address'),
-                        'locationName': order_data.get('location')
-                    })
-                else:
-                    print("⚠️ No fingerprint provided, skipping customer save")
-                
-                db.counter += 1
-                order = {
-                    'id': db.counter,
-                    'customerName': order_data.get('customer', 'عميل'),
-                    'phone': order_data.get('phone', ''),
-                    'items': order_data.get('items', ''),
-                    'total': float(order_data.get('total', 0)),
-                    'orderType': order_data.get('orderType', 'dine_in'),
-                    'location': order_data.get('location', 'غير محدد'),
-                    'address': order_data.get('address', ''),
-                    'carInfo': order_data.get('carInfo', ''),
-                    'deliveryNotes': order_data.get('deliveryNotes', ''),
-                    'status': 'new',
-                    'createdAt': datetime.now().isoformat(),
-                    'updatedAt': datetime.now().isoformat(),
-                    'source': 'AI_Chat',
-                    'fingerprint': fingerprint  # ✅ حفظ البصمة
-                }
-                
-                # ✅ استخدام الطريقة الجديدة للإضافة
-                db.add_order(order)
-                order_id = order['id']
-                
-                print(f"🔔 طلب جديد من AI #{order_id}: {order['customerName']}")
-
+            order_id = create_order_from_chat(order_match.group(1), fingerprint)
+            if order_id:
                 # إزالة بيانات الطلب من الرد
                 reply = re.sub(r'\[ORDER_DATA\].*?\[/ORDER_DATA\]', '', reply, flags=re.DOTALL).strip()
-                reply += f"\n\n📋 رقم طلبك: #{order_id}"
-
-            except Exception as e:
-                print(f"Error parsing order: {e}")
+                reply += f"\n\n📋 {ORDER_NUMBER_MARKER}: #{order_id}"
 
         return jsonify({
             "success": True,
@@ -758,6 +3458,22 @@ def chat_endpoint():
             "orderId": order_id
         })
 
+    except LLMBusyError:
+        print("⚠️ Chat rejected - all OpenAI slots busy")
+        return jsonify({
+            "success": False,
+            "error": "الخدمة مشغولة",
+            "reply": "في ضغط كبير هلأ، جرب بعد لحظات 🙏"
+        }), 503
+
+    except OrderNotSavedError as e:
+        print(f"Chat order not saved: {e}")
+        return jsonify({
+            "success": False,
+            "error": "قاعدة البيانات غير متاحة، حاول مرة أخرى",
+            "reply": "عذراً، ما قدرنا نسجل الطلب هلأ. ابعتلي تأكيد مرة ثانية بعد لحظة 🙏"
+        }), 503
+
     except Exception as e:
         print(f"Chat Error: {e}")
         return jsonify({
@@ -766,24 +3482,178 @@ def chat_endpoint():
             "reply": "عذراً، حصل خطأ. حاول مرة أخرى"
         }), 500
 
+ORDER_DATA_OPEN = '[ORDER_DATA]'
+ORDER_DATA_CLOSE = '[/ORDER_DATA]'
+
+class OrderDataStream:
+    """يمرر نص الـ AI للزبون أولاً بأول، ويحجز بلوك [ORDER_DATA]...[/ORDER_DATA] حتى يكتمل"""
+
+    def __init__(self):
+        self._buffer = ''
+        self._in_block = False
+
+    def feed(self, chunk):
+        """يرجع (نص جاهز للعرض، قائمة البلوكات التي اكتملت الآن)"""
+        self._buffer += chunk
+        visible = []
+        blocks = []
+        while True:
+            if self._in_block:
+                end = self._buffer.find(ORDER_DATA_CLOSE)
+                if end < 0:
+                    break
+                blocks.append(self._buffer[:end])
+                self._buffer = self._buffer[end + len(ORDER_DATA_CLOSE):]
+                self._in_block = False
+                continue
+            start = self._buffer.find(ORDER_DATA_OPEN)
+            if start >= 0:
+                visible.append(self._buffer[:start])
+                self._buffer = self._buffer[start + len(ORDER_DATA_OPEN):]
+                self._in_block = True
+                continue
+            # نحجز آخر جزء إذا كان ممكن يكون بداية الوسم (مثلاً "[ORD")
+            keep = 0
+            for k in range(min(len(self._buffer), len(ORDER_DATA_OPEN) - 1), 0, -1):
+                if ORDER_DATA_OPEN.startswith(self._buffer[-k:]):
+                    keep = k
+                    break
+            visible.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return ''.join(visible), blocks
+
+    def finish(self):
+        """باقي النص بعد انتهاء الرد (بلوك غير مكتمل لا يُعرض للزبون)"""
+        rest = '' if self._in_block else self._buffer
+        self._buffer = ''
+        return rest
+
+def sse_event(event, payload, event_id=None):
+    # app.json حتى تُحوَّل الطلبات بنفس طريقة jsonify
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {app.json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    """نفس /api/chat لكن كـ Server-Sent Events: token ثم order (عند اكتمال الطلب) ثم done"""
+    data = request.json
+    if not data or 'message' not in data:
+        return jsonify({"success": False, "error": "الرسالة مطلوبة"}), 400
+
+    fast_reply = quick_reply(data['message'], data.get('history'))
+    if fast_reply:
+        body = sse_event('token', {"text": fast_reply}) + sse_event('done', {
+            "success": True, "reply": fast_reply, "orderId": None, "fastPath": True
+        })
+        return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    fingerprint = data.get('fingerprint')
+    messages = build_chat_messages(data)
+
+    def generate():
+        extractor = OrderDataStream()
+        shown = []
+        order_id = None
+        try:
+            for delta in llm.stream_chat(messages):
+                text, blocks = extractor.feed(delta)
+                if text:
+                    shown.append(text)
+                    yield sse_event('token', {"text": text})
+                for block in blocks:
+                    # الطلب يُنشأ فور وصول وسم الإغلاق، بدون انتظار نهاية الرد
+                    if order_id is None:
+                        order_id = create_order_from_chat(block, fingerprint)
+                        if order_id:
+                            yield sse_event('order', {"orderId": order_id})
+            tail = extractor.finish()
+            if tail:
+                shown.append(tail)
+                yield sse_event('token', {"text": tail})
+
+            reply = ''.join(shown).strip()
+            if order_id:
+                reply += f"\n\n📋 {ORDER_NUMBER_MARKER}: #{order_id}"
+            yield sse_event('done', {"success": True, "reply": reply, "orderId": order_id})
+
+        except LLMBusyError:
+            print("⚠️ Chat stream rejected - all OpenAI slots busy")
+            yield sse_event('error', {
+                "success": False,
+                "error": "الخدمة مشغولة",
+                "reply": "في ضغط كبير هلأ، جرب بعد لحظات 🙏",
+                "orderId": order_id
+            })
+        except OrderNotSavedError as e:
+            print(f"Chat stream order not saved: {e}")
+            yield sse_event('error', {
+                "success": False,
+                "error": "قاعدة البيانات غير متاحة، حاول مرة أخرى",
+                "reply": "عذراً، ما قدرنا نسجل الطلب هلأ. ابعتلي تأكيد مرة ثانية بعد لحظة 🙏",
+                "orderId": None
+            })
+        except Exception as e:
+            print(f"Chat Stream Error: {e}")
+            yield sse_event('error', {
+                "success": False,
+                "error": "حدث خطأ في الخدمة",
+                "reply": "عذراً، حصل خطأ. حاول مرة أخرى",
+                "orderId": order_id
+            })
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/orders', methods=['GET'])
 def get_orders():
-    auto_cleanup()
     order_type = request.args.get('orderType')
-    filtered_orders = db.orders
+    # الـ cursor قبل القائمة: أي حدث بعده قد يتكرر في القائمة لكن لا يضيع
+    cursor = db.event_cursor()
+    orders = db.orders
+    filtered_orders = orders
     
     if order_type and order_type in ['dine_in', 'car_pickup', 'delivery']:
-        filtered_orders = [o for o in db.orders if o['orderType'] == order_type]
+        filtered_orders = [o for o in orders if o['orderType'] == order_type]
+    
+    by_type = {"dine_in": 0, "car_pickup": 0, "delivery": 0}
+    for o in orders:
+        if o.get('orderType') in by_type:
+            by_type[o['orderType']] += 1
     
     return jsonify({
         "success": True,
         "orders": filtered_orders,
         "total": len(filtered_orders),
-        "byType": {
-            "dine_in": len([o for o in db.orders if o['orderType'] == 'dine_in']),
-            "car_pickup": len([o for o in db.orders if o['orderType'] == 'car_pickup']),
-            "delivery": len([o for o in db.orders if o['orderType'] == 'delivery'])
-        }
+        "byType": by_type,
+        "cursor": cursor
+    })
+
+@app.route('/api/orders/events', methods=['GET'])
+def get_order_events():
+    """التغييرات فقط بعد cursor (من GET /api/orders أو من آخر رد) - create / update / delete"""
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', ORDER_EVENTS_PAGE))
+    except ValueError:
+        return jsonify({"success": False, "error": "after و limit يجب أن تكون أرقاماً"}), 400
+    if limit < 1:
+        return jsonify({"success": False, "error": "limit يجب أن يكون 1 على الأقل"}), 400
+    limit = min(limit, ORDER_EVENTS_PAGE)
+    try:
+        events, cursor, resync = db.events_after(after, limit)
+    except Exception as e:
+        print(f"Order events error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+    return jsonify({
+        "success": True,
+        "events": events,
+        "cursor": cursor,
+        "resync": resync,
+        "hasMore": len(events) == limit
     })
 
 @app.route('/api/orders', methods=['POST'])
@@ -792,9 +3662,8 @@ def create_order():
     if not data or 'customerName' not in data or 'items' not in data:
         return jsonify({"success": False, "error": "البيانات ناقصة"}), 400
     
-    db.counter += 1
     order = {
-        'id': db.counter,
+        'id': db.next_order_id(),
         'customerName': data['customerName'],
         'phone': data.get('phone', ''),
         'items': data['items'],
@@ -806,19 +3675,23 @@ def create_order():
         'deliveryNotes': data.get('deliveryNotes', ''),
         'notes': data.get('notes', ''),
         'status': 'new',
-        'createdAt': datetime.now().isoformat(),
-        'updatedAt': datetime.now().isoformat(),
+        'createdAt': now_local(),
+        'updatedAt': now_local(),
         'source': 'Manual'
     }
     
-    db.add_order(order)
+    try:
+        db.add_order(order)
+    except OrderNotSavedError as e:
+        print(f"Manual order not saved: {e}")
+        return jsonify({"success": False, "error": "قاعدة البيانات غير متاحة، حاول مرة أخرى"}), 503
     print(f"📝 طلب يدوي #{order['id']}: {order['customerName']}")
     
     return jsonify({"success": True, "order": order})
 
 @app.route('/api/orders/<int:order_id>', methods=['GET'])
 def get_order(order_id):
-    order = next((o for o in db.orders if o['id'] == order_id), None)
+    order = db.get_order(order_id)
     if not order:
         return jsonify({"success": False, "error": "الطلب غير موجود"}), 404
     
@@ -844,182 +3717,352 @@ def get_order(order_id):
 
 @app.route('/api/orders/<int:order_id>', methods=['PATCH'])
 def update_order(order_id):
-    order = next((o for o in db.orders if o['id'] == order_id), None)
+    order = db.get_order(order_id)
     if not order:
         return jsonify({"success": False, "error": "الطلب غير موجود"}), 404
     
-    data = request.json
-    previous_status = order['status']
+    data = request.json or {}
+    now = now_local()
+    updates = {'updatedAt': now}
+    new_status = data.get('status')
     
-    if 'status' in data:
-        order['status'] = data['status']
-        print(f"📝 تحديث #{order['id']}: {order['status']}")
-        
-        if order['status'] == 'ready' and previous_status != 'ready':
+    if new_status is not None and new_status not in ORDER_TRANSITIONS:
+        return jsonify({"success": False, "error": "حالة غير معروفة"}), 400
+    
+    if new_status == order['status']:
+        # نفس الحالة (ضغطة مكررة) - لا يوجد انتقال
+        new_status = None
+    
+    if new_status is not None:
+        updates['status'] = new_status
+        if new_status == 'ready':
             order_type_msg = {
                 'dine_in': 'يمكنك استلامه من الكاونتر',
                 'car_pickup': 'سنوصله لسيارتك الآن',
                 'delivery': 'جاري توصيله إليك'
             }
-            
-            msg_text = f"🎉 تم تجهيز طلبك #{order['id']}! {order_type_msg.get(order['orderType'], '')}"
-            order['readyNotification'] = {
+            msg_text = f"🎉 تم تجهيز طلبك #{order_id}! {order_type_msg.get(order['orderType'], '')}"
+            updates['readyNotification'] = {
                 'sent': True,
                 'message': msg_text,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now
             }
-            
-            # Broadcast WebSocket
-            manager.broadcast({
-                'type': 'order_ready',
-                'orderId': order['id'],
-                'message': msg_text,
-                'orderType': order['orderType'],
-                'customerName': order['customerName'],
-                'timestamp': datetime.now().isoformat()
-            })
-            
-            manager.send_to_order(order['id'], {
-                'type': 'order_ready',
-                'orderId': order['id'],
-                'message': msg_text,
-                'timestamp': datetime.now().isoformat()
-            })
-            
+    
     if 'notes' in data:
-        order['notes'] = data['notes']
-        # Update MongoDB
-        db.update_order(order['id'], {'notes': order['notes']})
+        updates['notes'] = data['notes']
+    
+    # رحلة واحدة: الحالة + الملاحظات + الإشعار + الوقت معاً، بشرط أن الانتقال مسموح
+    try:
+        order = db.transition_order(order_id, updates, new_status)
+        if order is None:
+            # None = الـ compare-and-set خسر فعلاً (أخطاء MongoDB لا تصل هنا كـ None)
+            current = db.get_order(order_id, fresh=True)
+            if current is None or new_status is None:
+                return jsonify({"success": False, "error": "الطلب غير موجود"}), 404
+            if current['status'] == new_status:
+                # تابلت آخر سبقنا لنفس الحالة - نحفظ باقي التعديلات بدون إشعار مكرر
+                updates.pop('status')
+                updates.pop('readyNotification', None)
+                return jsonify({"success": True, "order": db.transition_order(order_id, updates) or current})
+            return jsonify({
+                "success": False,
+                "error": f"لا يمكن تغيير حالة الطلب من {current['status']} إلى {new_status}",
+                "status": current['status'],
+                "allowed": list(ORDER_TRANSITIONS.get(current['status'], ()))
+            }), 409
+    except Exception as e:
+        print(f"Error updating order #{order_id}: {e}")
+        return jsonify({"success": False, "error": "قاعدة البيانات غير متاحة، حاول مرة أخرى"}), 503
+    
+    if new_status is not None:
+        print(f"📝 تحديث #{order_id}: {new_status}")
+    
+    if new_status == 'ready':
+        msg_text = order['readyNotification']['message']
+        db.add_ready_notification(order, now)
+        
+        # شاشات العمال (الكل + شاشة نوع الطلب) فقط - الزبائن الآخرون لا يرون اسم الزبون
+        manager.publish([STAFF_TOPIC, order_type_topic(order['orderType'])], {
+            'type': 'order_ready',
+            'orderId': order_id,
+            'message': msg_text,
+            'orderType': order['orderType'],
+            'customerName': order['customerName'],
+            'timestamp': now.isoformat()
+        })
+        print(f"📢 تم إرسال إشعار جاهزية لشاشات العمال - الطلب #{order_id}")
         
-    order['updatedAt'] = datetime.now().isoformat()
-    # Update timestamp in MongoDB
-    db.update_order(order['id'], {'updatedAt': order['updatedAt']})
+        manager.send_to_order(order_id, {
+            'type': 'order_ready',
+            'orderId': order_id,
+            'message': msg_text,
+            'timestamp': now.isoformat()
+        })
     
     return jsonify({"success": True, "order": order})
 
 @app.route('/api/orders/<int:order_id>', methods=['DELETE'])
 def delete_order(order_id):
-    # البحث في MongoDB مباشرة
-    if db_orders:
-        try:
-            result = db_orders.delete_one({'id': order_id})
-            if result.deleted_count > 0:
-                print(f"🗑️ Deleted order #{order_id} from MongoDB")
-                return jsonify({"success": True, "message": "تم حذف الطلب"})
-        except Exception as e:
-            print(f"Error deleting from Mongo: {e}")
+    if db.delete_order(order_id):
+        print(f"🗑️ Deleted order #{order_id} from MongoDB")
+        return jsonify({"success": True, "message": "تم حذف الطلب"})
             
     return jsonify({"success": False, "error": "الطلب غير موجود"}), 404
 
+STATS_CACHE_SECONDS = float(os.getenv('STATS_CACHE_SECONDS', 2))
+
+class SingleFlightCache:
+    """قيمة محسوبة مع TTL قصير - الطلبات المتزامنة تنتظر نفس الحساب بدل تكراره"""
+
+    def __init__(self, ttl, loader):
+        self.ttl = ttl
+        self.loader = loader
+        self._value = None
+        self._expires = 0
+        self._loading = False
+        self._cond = threading.Condition()
+
+    def get(self):
+        with self._cond:
+            while True:
+                if time.monotonic() < self._expires:
+                    return self._value
+                if not self._loading:
+                    self._loading = True
+                    break
+                # تابلت آخر يحسب الآن - ننتظر نتيجته
+                self._cond.wait()
+        try:
+            value = self.loader()
+        except Exception:
+            with self._cond:
+                self._loading = False
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._value = value
+            self._expires = time.monotonic() + self.ttl
+            self._loading = False
+            self._cond.notify_all()
+        return value
+
+def stats_pipelines(today):
+    """
+    أرقام /api/stats - aggregation لكل جزء، كل واحدة على فهرس ($facet لا يستخدم الفهارس أصلاً).
+    byStatus/byType: $sort على أول حقل في فهرس (status/orderType, createdAt) فيصير group-by قراءة مغطاة من الفهرس.
+    today: $match على createdAt.
+    """
+    return {
+        "byStatus": [{"$sort": {"status": 1}}, {"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+        "byType": [{"$sort": {"orderType": 1}}, {"$group": {"_id": "$orderType", "count": {"$sum": 1}}}],
+        "today": [
+            {"$match": {"createdAt": {"$gte": today}}},
+            {"$group": {
+                "_id": None,
+                "count": {"$sum": 1},
+                # الإيراد من الطلبات المسلّمة فقط
+                "revenue": {"$sum": {"$cond": [{"$eq": ["$status", "delivered"]}, "$total", 0]}}
+            }}
+        ]
+    }
+
+def compute_stats():
+    facets = {name: list(db_orders.aggregate(pipeline))
+              for name, pipeline in stats_pipelines(local_midnight()).items()}
+    by_status = {item['_id']: item['count'] for item in facets['byStatus']}
+    by_type = {item['_id']: item['count'] for item in facets['byType']}
+    today = facets['today'][0] if facets['today'] else {'count': 0, 'revenue': 0}
+    return {
+        "total": sum(by_status.values()),
+        "today": today['count'],
+        "todayRevenue": today['revenue'],
+        "byStatus": {
+            "new": by_status.get('new', 0),
+            "preparing": by_status.get('preparing', 0),
+            "ready": by_status.get('ready', 0),
+            "delivered": by_status.get('delivered', 0),
+            "cancelled": by_status.get('cancelled', 0)
+        },
+        "byType": {
+            "dine_in": by_type.get('dine_in', 0),
+            "car_pickup": by_type.get('car_pickup', 0),
+            "delivery": by_type.get('delivery', 0)
+        }
+    }
+
+stats_cache = SingleFlightCache(STATS_CACHE_SECONDS, compute_stats)
+
 @app.route('/api/stats', methods=['GET'])
 def get_stats():
     # auto_cleanup() # Removed to avoid heavy operations on every stats call
     
-    if not db_orders:
+    if db_orders is None:
         return jsonify({"success": False, "error": "Database not connected"})
         
     try:
-        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        today_iso = today.isoformat()
-        
-        # Count directly from MongoDB
-        total_orders = db_orders.count_documents({})
-        today_count = db_orders.count_documents({'createdAt': {'$gte': today_iso}})
-        
-        # Aggregation for status
-        status_counts = list(db_orders.aggregate([
-            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
-        ]))
-        by_status = {item['_id']: item['count'] for item in status_counts}
-        
-        # Aggregation for type
-        type_counts = list(db_orders.aggregate([
-            {"$group": {"_id": "$orderType", "count": {"$sum": 1}}}
-        ]))
-        by_type = {item['_id']: item['count'] for item in type_counts}
-        
-        # Calculate revenue (only delivered)
-        revenue_pipeline = [
-            {"$match": {"status": "delivered", "createdAt": {"$gte": today_iso}}},
-            {"$group": {"_id": None, "total": {"$sum": "$total"}}}
-        ]
-        revenue_result = list(db_orders.aggregate(revenue_pipeline))
-        today_revenue = revenue_result[0]['total'] if revenue_result else 0
-        
-        return jsonify({
-            "success": True,
-            "stats": {
-                "total": total_orders,
-                "today": today_count,
-                "todayRevenue": today_revenue,
-                "byStatus": {
-                    "new": by_status.get('new', 0),
-                    "preparing": by_status.get('preparing', 0),
-                    "ready": by_status.get('ready', 0),
-                    "delivered": by_status.get('delivered', 0),
-                    "cancelled": by_status.get('cancelled', 0)
-                },
-                "byType": {
-                    "dine_in": by_type.get('dine_in', 0),
-                    "car_pickup": by_type.get('car_pickup', 0),
-                    "delivery": by_type.get('delivery', 0)
-                }
-            }
-        })
+        # كل التابلتات التي تسأل خلال ثانيتين تأخذ نفس النتيجة من استعلام واحد
+        return jsonify({"success": True, "stats": stats_cache.get()})
     except Exception as e:
         print(f"Stats Error: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/analytics', methods=['GET'])
+def get_analytics():
+    """تاريخ المبيعات من order_rollups (يبقى بعد المسح اليومي) - ?days=30&granularity=day|hour"""
+    try:
+        days = max(1, min(int(request.args.get('days', 30)), ANALYTICS_MAX_DAYS))
+    except ValueError:
+        return jsonify({"success": False, "error": "days يجب أن يكون رقماً"}), 400
+    kind = request.args.get('granularity', 'day')
+    if kind not in ROLLUP_BUCKETS:
+        return jsonify({"success": False, "error": "granularity: day أو hour"}), 400
+    try:
+        periods = sales_history(days, kind)
+    except Exception as e:
+        print(f"Analytics Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    items = {}
+    for period in periods:
+        for name, qty in period.get('items', {}).items():
+            items[name] = items.get(name, 0) + qty
+    return jsonify({
+        "success": True,
+        "periods": periods,
+        "totals": {
+            "orders": sum(p.get('orders', 0) for p in periods),
+            "revenue": sum(p.get('revenue', 0) for p in periods),
+            "topItems": sorted(items.items(), key=lambda kv: kv[1], reverse=True)[:10]
+        }
+    })
+
+LONG_POLL_MAX_SECONDS = 25
+ORDER_STREAM_KEEPALIVE_SECONDS = 15
+# حدث create يصل order_events بعد الطلب نفسه (write-behind) - نعيد الفحص بعد وصول الطلب للكاش
+ORDER_STREAM_RECHECK_SECONDS = 1
+
+def created_orders(events):
+    """[(seq، الطلب)] لأحداث create - الطلب بحالته الحالية من الكاش إن وجد"""
+    return [
+        (event['seq'], db.cache.get(event['orderId']) or event['data'])
+        for event in events if event['op'] == 'create'
+    ]
+
 @app.route('/api/orders/poll', methods=['GET'])
 def poll_orders():
-    since = int(request.args.get('since', 1000))
-    # Simple short polling response instead of long polling for Flask simplicity
-    # The client can poll every few seconds
-    new_orders = [o for o in db.orders if o['id'] > since]
+    """
+    طلبات جديدة بعد cursor سجل التغييرات (after، من GET /api/orders أو من آخر رد).
+    مع wait=N (ثواني) يبقى الطلب معلقاً حتى يصل طلب جديد أو تنتهي المهلة بدل ما تسأل الشاشة كل كم ثانية.
+    أرقام الطلبات لا تصلح كـ cursor: كل worker يحجز كتلة أرقام فلا تصل بالترتيب.
+    الشاشات القديمة (since=<lastId> بدون after) تبقى على العقد القديم: {hasUpdates, orders, lastId}.
+    """
+    try:
+        after = int(request.args['after']) if request.args.get('after') else None
+        since = int(request.args['since']) if request.args.get('since') and after is None else None
+        wait = min(max(float(request.args.get('wait', 0) or 0), 0), LONG_POLL_MAX_SECONDS)
+    except ValueError:
+        return jsonify({"success": False, "error": "after و since و wait يجب أن تكون أرقاماً"}), 400
+    deadline = time.monotonic() + wait
+
+    if since is not None:
+        return poll_orders_since(since, deadline)
     
-    if new_orders:
-        last_id = max(o['id'] for o in new_orders)
-        return jsonify({
-            "hasUpdates": True,
-            "orders": new_orders,
-            "lastId": last_id
-        })
-    return jsonify({"hasUpdates": False, "lastId": since})
+    try:
+        cursor = db.event_cursor() if after is None else after
+        while True:
+            version = db.cache.version
+            events, cursor, resync = db.events_after(cursor)
+            new_orders = created_orders(events)
+            remaining = deadline - time.monotonic()
+            if new_orders or resync or remaining <= 0:
+                break
+            db.cache.wait_for_arrivals(version, min(remaining, ORDER_STREAM_RECHECK_SECONDS))
+    except Exception as e:
+        print(f"Poll Error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 503
+    
+    return jsonify({
+        "hasUpdates": bool(new_orders),
+        "orders": [order for _, order in new_orders],
+        "cursor": cursor,
+        # resync: الـ cursor أقدم من السجل - الشاشة تعيد تحميل GET /api/orders
+        "resync": resync
+    })
 
-@app.route('/api/notifications/ready', methods=['GET'])
-def get_ready_notifications():
-    since_str = request.args.get('since')
+def poll_orders_since(since, deadline):
+    """العقد القديم: طلبات رقمها أكبر من since من الكاش (قد يفوت طلباً من worker آخر حجز أرقاماً أصغر)"""
+    while True:
+        version = db.cache.version
+        new_orders = [o for o in db.cache.recent() if o['id'] > since]
+        remaining = deadline - time.monotonic()
+        if new_orders or remaining <= 0:
+            break
+        db.cache.wait_for_arrivals(version, remaining)
+    return jsonify({
+        "hasUpdates": bool(new_orders),
+        "orders": new_orders,
+        "lastId": max([o['id'] for o in new_orders] + [since])
+    })
+
+@app.route('/api/orders/stream', methods=['GET'])
+def stream_orders():
+    """
+    SSE للطلبات الجديدة - id كل حدث هو seq في order_events، فيستأنف المتصفح تلقائياً
+    عبر Last-Event-ID بعد انقطاع الاتصال (حتى لو وصل لـ worker آخر).
+    """
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('after')
     try:
-        if since_str:
-            since_clean = since_str.replace('Z', '').split('+')[0].split('.')[0]
-            since_time = datetime.fromisoformat(since_clean)
-        else:
-            since_time = datetime.now() - timedelta(minutes=1)
-    except:
-        since_time = datetime.now() - timedelta(minutes=1)
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        last_id = None
 
-    ready_orders = []
-    for o in db.orders:
-        if o['status'] == 'ready' and o.get('readyNotification'):
+    def generate():
+        cursor = db.event_cursor() if last_id is None else last_id
+        idle_since = time.monotonic()
+        while True:
+            version = db.cache.version
             try:
-                notif_time_str = o['readyNotification']['timestamp'].split('+')[0].split('.')[0]
-                notif_time = datetime.fromisoformat(notif_time_str)
-                if notif_time > since_time:
-                    ready_orders.append(o)
-            except:
-                pass
-    
+                events, cursor, resync = db.events_after(cursor)
+            except Exception as e:
+                print(f"Order stream error: {e}")
+                events, resync = [], False
+            for seq, order in created_orders(events):
+                yield sse_event('order', order, event_id=seq)
+                idle_since = time.monotonic()
+            if resync:
+                # فات الشاشة أكثر مما يحفظه السجل - تعيد التحميل الكامل ثم تكمل من هنا
+                yield sse_event('resync', {"cursor": cursor}, event_id=cursor)
+                idle_since = time.monotonic()
+            if events or resync:
+                continue
+            if time.monotonic() - idle_since >= ORDER_STREAM_KEEPALIVE_SECONDS:
+                yield ": keepalive\n\n"
+                idle_since = time.monotonic()
+            db.cache.wait_for_arrivals(version, ORDER_STREAM_RECHECK_SECONDS)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def parse_since(value, default_minutes=1):
+    """since من الشاشة -> datetime aware. بدون منطقة زمنية = توقيت المطعم"""
+    try:
+        since = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return now_local() - timedelta(minutes=default_minutes)
+    if since.tzinfo is None:
+        return LOCAL_TZ.localize(since)
+    return since
+
+@app.route('/api/notifications/ready', methods=['GET'])
+def get_ready_notifications():
+    since = parse_since(request.args.get('since'))
+    notifications = db.ready_notifications_since(since)
     return jsonify({
         "success": True,
-        "notifications": [
-            {
-                "orderId": o['id'],
-                "message": o['readyNotification']['message'],
-                "timestamp": o['readyNotification']['timestamp'],
-                "orderType": o.get('orderType', 'dine_in')
-            }
-            for o in ready_orders
-        ]
+        "notifications": notifications
     })
 
 @app.route('/api/test-db', methods=['GET'])
@@ -1052,7 +4095,7 @@ def test_db_connection():
         
         # 3. Test Write/Read
         try:
-            db.test_connection.insert_one({"test": "ok", "time": datetime.now().isoformat()})
+            db.test_connection.insert_one({"test": "ok", "time": now_local()})
             doc = db.test_connection.find_one({"test": "ok"})
             
             if doc:
@@ -1083,30 +4126,268 @@ def health_check():
         "server": "ملك الطابون - Backend (Flask)",
         "version": "3.1.0-flask",
         "orders": len(db.orders),
+        "orderCache": {"size": len(db.cache), "sync": db.cache.mode},
+        "notifications": backplane.mode,
+        "websockets": manager.stats()["connections"],
+        "retention": retention.last_report,
+        "customerCache": customer_cache.stats(),
+        "writeBehind": write_behind.stats(),
+        "journal": {"pending": len(journal.pending)},
         "uptime": "running"
     })
 
+@app.route('/api/ws/stats', methods=['GET'])
+def websocket_stats():
+    """أعداد اتصالات WebSocket الحية في هذا الـ worker (لتحديد حجم السيرفر)"""
+    return jsonify({"success": True, "stats": manager.stats()})
+
 @app.route('/api/cleanup', methods=['DELETE'])
 def manual_cleanup():
-    if db_orders:
+    if db_orders is not None:
         try:
-            # حذف جميع الطلبات
-            result = db_orders.delete_many({})
-            count = result.deleted_count
-            # db.counter = 1000 # اختياري
+            # مسح جميع الطلبات الآن (أرشفة ثم حذف)
+            report = retention.run()
+            if report is None:
+                return jsonify({"success": False, "error": "التنظيف يعمل الآن، حاول بعد قليل"}), 409
+            count = report['deleted']
             print(f"🧹 تم مسح {count} طلب من MongoDB يدوياً")
-            return jsonify({"success": True, "message": f"تم مسح {count} طلب من قاعدة البيانات"})
+            return jsonify({"success": True, "message": f"تم مسح {count} طلب من قاعدة البيانات", "report": report})
         except Exception as e:
             print(f"Error in manual_cleanup: {e}")
             return jsonify({"success": False, "error": str(e)}), 500
             
     return jsonify({"success": False, "error": "Database not connected"}), 500
 
+# ═══════════════════════════════════════════════════════════════════════════
+# 🗂️ الفهارس (Indexes) - تُنشأ عند التشغيل، وفحص خطط الاستعلامات
+# python server.py check-indexes
+# ═══════════════════════════════════════════════════════════════════════════
+
+INDEX_SPECS = {
+    'orders': [
+        IndexModel([('id', 1)], unique=True),
+        # range scans الإحصائيات والتنظيف على createdAt (BSON Date)
+        IndexModel([('createdAt', 1)]),
+        IndexModel([('status', 1), ('createdAt', 1)]),
+        IndexModel([('orderType', 1), ('createdAt', 1)])
+    ],
+    # customers: البحث بالبصمة على _id (فهرس تلقائي)
+    'customers': [],
+    'order_events': [IndexModel([('at', 1)], expireAfterSeconds=ORDER_EVENTS_TTL_SECONDS)],
+    'ready_notifications': [IndexModel([('at', 1)], expireAfterSeconds=READY_NOTIFICATIONS_TTL_SECONDS)],
+    'notifications': [IndexModel([('at', 1)], expireAfterSeconds=NOTIFY_TTL_SECONDS)],
+    'order_rollups': [IndexModel([('kind', 1), ('date', 1)])],
+    'orders_archive': [IndexModel([('archivedAt', 1)], expireAfterSeconds=ARCHIVE_TTL_DAYS * 24 * 3600)],
+    'locks': []
+}
+
+# collections تحتاج خيارات عند الإنشاء (قبل أن ينشئها أول insert بالإعدادات الافتراضية)
+COLLECTION_OPTIONS = {
+    'orders_archive': {'storageEngine': {'wiredTiger': {'configString': 'block_compressor=zstd'}}}
+}
+
+def mongo_collections():
+    """أسماء الـ collections -> الكائنات الحالية (None إذا لا يوجد اتصال)"""
+    return {
+        'orders': db_orders,
+        'customers': db_customers,
+        'counters': db_counters,
+        'order_events': db_order_events,
+        'ready_notifications': db_ready_notifications,
+        'notifications': db_notifications,
+        'order_rollups': db_rollups,
+        'orders_archive': db_archive,
+        'locks': db_locks
+    }
+
+def ensure_collections():
+    if STORAGE_BACKEND != 'mongo':
+        return
+    collections = mongo_collections()
+    for name, options in COLLECTION_OPTIONS.items():
+        collection = collections[name]
+        if collection is None:
+            continue
+        try:
+            if name not in collection.database.list_collection_names(filter={'name': name}):
+                collection.database.create_collection(name, **options)
+        except Exception as e:
+            print(f"Error creating {name} collection: {e}")
+
+def ensure_indexes():
+    """ينشئ الفهارس الناقصة - create_indexes لا يفعل شيئاً إذا كانت موجودة"""
+    ensure_collections()
+    collections = mongo_collections()
+    for name, models in INDEX_SPECS.items():
+        if collections[name] is None or not models:
+            continue
+        try:
+            collections[name].create_indexes(models)
+        except Exception as e:
+            print(f"Error creating {name} indexes: {e}")
+
+def hot_queries():
+    """الاستعلامات المتكررة كما ينفذها الكود - (الاسم، collection، أمر explain)"""
+    today = local_midnight()
+    return [
+        ('order cache load', 'orders',
+         {'find': 'orders', 'filter': {}, 'sort': {'id': -1}, 'limit': ORDER_CACHE_MAX}),
+        ('get order by _id', 'orders', {'find': 'orders', 'filter': {'_id': ORDER_ID_START}}),
+        ('update/delete order by id', 'orders',
+         {'delete': 'orders', 'deletes': [{'q': {'id': ORDER_ID_START}, 'limit': 1}]}),
+        ('max order id (Sequence seed)', 'orders',
+         {'find': 'orders', 'filter': {}, 'sort': {'_id': -1}, 'limit': 1}),
+        ('order id counter', 'counters', {'find': 'counters', 'filter': {'_id': 'orders'}}),
+        *[(f'stats {part}', 'orders', {'aggregate': 'orders', 'cursor': {}, 'pipeline': pipeline})
+          for part, pipeline in stats_pipelines(today).items()],
+        ('retention batch', 'orders',
+         {'find': 'orders', 'filter': {'createdAt': {'$not': {'$gte': today}}}, 'projection': {'_id': 1},
+          'limit': RETENTION_BATCH}),
+        ('retention delete', 'orders',
+         {'delete': 'orders', 'deletes': [{'q': {'_id': {'$in': [ORDER_ID_START]}}, 'limit': 0}]}),
+        ('customer by fingerprint', 'customers', {'find': 'customers', 'filter': {'_id': 'fingerprint'}}),
+        ('order events after cursor', 'order_events',
+         {'find': 'order_events', 'filter': {'_id': {'$gt': 0}}, 'sort': {'_id': 1}, 'limit': ORDER_EVENTS_PAGE}),
+        ('ready notifications since', 'ready_notifications',
+         {'find': 'ready_notifications', 'filter': {'at': {'$gt': today}}, 'sort': {'at': 1},
+          'limit': READY_NOTIFICATIONS_LIMIT}),
+        ('sales history', 'order_rollups',
+         {'find': 'order_rollups', 'filter': {'kind': 'day', 'date': {'$gte': local_midnight(days_ago=ANALYTICS_MAX_DAYS)}},
+          'sort': {'date': 1}}),
+        ('backplane poll', 'notifications',
+         {'find': 'notifications', 'filter': {'at': {'$gte': today}}, 'sort': {'at': 1}}),
+    ]
+
+def _plan_stages(node, found=None):
+    """كل الـ stages في خطة explain (بدون rejectedPlans)"""
+    found = [] if found is None else found
+    if isinstance(node, dict):
+        if isinstance(node.get('stage'), str):
+            found.append(node['stage'])
+        for key, value in node.items():
+            if key != 'rejectedPlans':
+                _plan_stages(value, found)
+    elif isinstance(node, list):
+        for value in node:
+            _plan_stages(value, found)
+    return found
+
+def _find_key(node, key):
+    if isinstance(node, dict):
+        if key in node:
+            return node[key]
+        node = list(node.values())
+    if isinstance(node, list):
+        for value in node:
+            found = _find_key(value, key)
+            if found is not None:
+                return found
+    return None
+
+def check_indexes():
+    """explain لكل استعلام متكرر - يرجع False إذا وقع أي منها في COLLSCAN"""
+    if STORAGE_BACKEND != 'mongo':
+        print(f"⚠️ check-indexes needs MongoDB (STORAGE_BACKEND={STORAGE_BACKEND})")
+        return True
+    collections = mongo_collections()
+    ok = True
+    for name, collection_name, command in hot_queries():
+        collection = collections[collection_name]
+        if collection is None:
+            print(f"⚠️ {name}: MongoDB is not connected - skipped")
+            continue
+        try:
+            plan = collection.database.command({'explain': command, 'verbosity': 'executionStats'})
+        except Exception as e:
+            print(f"❌ {name}: explain failed ({e})")
+            ok = False
+            continue
+        stages = _plan_stages(plan)
+        examined = _find_key(plan, 'totalDocsExamined')
+        millis = _find_key(plan, 'executionTimeMillis')
+        if 'COLLSCAN' in stages:
+            ok = False
+            print(f"❌ {name}: COLLSCAN ({' -> '.join(stages)})")
+        else:
+            print(f"✅ {name}: {' -> '.join(stages)} ({examined} docs examined, {millis} ms)")
+    return ok
+
+ensure_indexes()
+
+# بعد اتصال متأخر بـ MongoDB (بدأ السيرفر بدون اتصال)
+MONGO_CONNECT_HOOKS.extend([ensure_indexes, db.cache.load])
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🛠️ ترحيل التواريخ القديمة (نصوص ISO -> BSON Date)
+# python server.py migrate-dates
+# ═══════════════════════════════════════════════════════════════════════════
+
+MIGRATION_BATCH = 500
+TIMESTAMP_FIELDS = {
+    'orders': ('createdAt', 'updatedAt', 'readyNotification.timestamp'),
+    'customers': ('lastVisit',),
+    'ready_notifications': ('timestamp',)
+}
+
+def parse_legacy_timestamp(value):
+    """النصوص القديمة كُتبت بـ datetime.now() - أي بتوقيت السيرفر إذا لم يكن فيها فرق توقيت"""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.astimezone()   # naive = توقيت الجهاز
+    return parsed.astimezone(LOCAL_TZ)
+
+def migrate_timestamps(batch=MIGRATION_BATCH):
+    """يحوّل كل تاريخ مخزّن كنص إلى BSON Date - آمن للتشغيل أكثر من مرة"""
+    collections = {
+        'orders': db_orders,
+        'customers': db_customers,
+        'ready_notifications': db_ready_notifications
+    }
+    for name, collection in collections.items():
+        if collection is None:
+            print(f"⚠️ {name}: MongoDB is not connected - skipped")
+            continue
+        fields = TIMESTAMP_FIELDS[name]
+        query = {'$or': [{field: {'$type': 'string'}} for field in fields]}
+        ops, migrated, failed = [], 0, 0
+        for doc in collection.find(query, projection={field: 1 for field in fields}):
+            updates = {}
+            for field in fields:
+                _, value = _get_field(doc, field)
+                if not isinstance(value, str):
+                    continue
+                try:
+                    updates[field] = parse_legacy_timestamp(value)
+                except ValueError:
+                    failed += 1
+            if updates:
+                ops.append(UpdateOp({'_id': doc['_id']}, {'$set': updates}))
+            if len(ops) >= batch:
+                migrated += collection.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            migrated += collection.bulk_write(ops, ordered=False).modified_count
+        print(f"🛠️ {name}: {migrated} documents migrated, {failed} unparseable values left as-is")
+
 # ═══════════════════════════════════════════════════════════════════════════
 # 🚀 Startup
 # ═══════════════════════════════════════════════════════════════════════════
 
+# أوامر الصيانة: python server.py migrate-dates / check-indexes
+MAINTENANCE_COMMAND = sys.argv[1] if __name__ == "__main__" and sys.argv[1:] in (['migrate-dates'], ['check-indexes']) else None
+
+# Start retention thread - في آخر الملف حتى تكون كل الدوال التي يستخدمها معرّفة،
+# ولا يعمل مع أوامر الصيانة (لا حذف كأثر جانبي لـ check-indexes)
+if MAINTENANCE_COMMAND is None:
+    threading.Thread(target=retention.loop, daemon=True).start()
+
 if __name__ == "__main__":
+    if MAINTENANCE_COMMAND == 'migrate-dates':
+        migrate_timestamps()
+        sys.exit(0)
+    if MAINTENANCE_COMMAND == 'check-indexes':
+        sys.exit(0 if check_indexes() else 1)
+
     print("""
 ╔═══════════════════════════════════════════════════════════════════════════╗
 ║                                                                           ║
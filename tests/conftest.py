@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# server.py يقرأ الإعدادات عند الاستيراد - SQLite في مجلد مؤقت، بدون MongoDB
+_DATA_DIR = tempfile.mkdtemp(prefix='taboon-tests-')
+os.environ['STORAGE_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = os.path.join(_DATA_DIR, 'taboon.db')
+os.environ['JOURNAL_PATH'] = os.path.join(_DATA_DIR, 'order_journal.jsonl')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+import pytest
+
+from server import catalog_reply, price_order
+
+
+def test_price_order_quantities_and_items():
+    priced = price_order('2 بيتزا تونا، ماء صغير')
+    assert priced['lines'] == [{'name': 'بيتزا تونا', 'price': 25.0, 'qty': 2},
+                               {'name': 'ماء صغير', 'price': 2.0, 'qty': 1}]
+    assert priced['total'] == 52.0
+    assert priced['verified'] is True
+
+
+def test_price_order_quantity_after_item():
+    assert price_order('بيتزا تونا ×3')['subtotal'] == 75.0
+
+
+def test_price_order_delivery_fee():
+    priced = price_order('بيتزا تونا', 'delivery', 'العيزرية')
+    assert (priced['deliveryFee'], priced['total'], priced['verified']) == (15, 40.0, True)
+
+
+def test_price_order_unknown_area_is_not_verified():
+    priced = price_order('بيتزا تونا', 'delivery', 'رام الله')
+    assert priced['deliveryFee'] is None
+    assert priced['verified'] is False
+
+
+def test_price_order_unknown_item():
+    priced = price_order('كولا')
+    assert priced['unmatched'] == ['كولا']
+    assert priced['verified'] is False
+
+
+def test_catalog_reply_price():
+    assert catalog_reply('بكم بيتزا تونا؟') == 'بيتزا تونا بـ 25 شيكل 😋 بتحب أسجللك ياه؟'
+
+
+def test_catalog_reply_delivery_area():
+    assert catalog_reply('بتوصلو عالعيزرية؟').endswith('التوصيل على العيزرية بـ 15 شيكل')
+
+
+@pytest.mark.parametrize('message', [
+    'بدي اطلب بيتزا تونا',   # طلب - للـ AI
+    'كم بدها وقت؟',          # "بدها" ليست "كبده"
+])
+def test_catalog_reply_leaves_to_ai(message):
+    assert catalog_reply(message) is None
@@ -0,0 +1,48 @@
+from server import ORDER_DATA_CLOSE, ORDER_DATA_OPEN, OrderDataStream, compact_history
+
+
+def feed_all(chunks):
+    stream = OrderDataStream()
+    visible, blocks = '', []
+    for chunk in chunks:
+        text, done = stream.feed(chunk)
+        visible += text
+        blocks += done
+    return visible + stream.finish(), blocks
+
+
+def test_stream_hides_order_block_split_across_chunks():
+    reply = f'تم! {ORDER_DATA_OPEN}{{"items": "بيتزا"}}{ORDER_DATA_CLOSE} شكراً'
+    chunks = [reply[i:i + 3] for i in range(0, len(reply), 3)]
+    assert feed_all(chunks) == ('تم!  شكراً', ['{"items": "بيتزا"}'])
+
+
+def test_stream_drops_unfinished_block():
+    assert feed_all(['أهلاً ', ORDER_DATA_OPEN, '{"items"']) == ('أهلاً ', [])
+
+
+def test_stream_keeps_text_that_only_looks_like_a_tag():
+    assert feed_all(['سعر [OR', 'D] 5']) == ('سعر [ORD] 5', [])
+
+
+def history(n, size=40):
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'{i} ' + 'x' * size} for i in range(n)]
+
+
+def test_compact_history_under_budget():
+    turns, summary = compact_history(history(4), budget=1000)
+    assert len(turns) == 4
+    assert summary is None
+
+
+def test_compact_history_cuts_in_steps_and_summarizes():
+    turns, summary = compact_history(history(20), budget=100, step=4)
+    assert len(turns) % 2 == 0
+    assert turns[-1]['content'].startswith('19 ')
+    assert summary.startswith('[Earlier conversation trimmed: ')
+
+
+def test_compact_history_always_keeps_last_exchange():
+    turns, summary = compact_history(history(3, size=4000), budget=10, step=6)
+    assert [t['content'][:2] for t in turns] == ['1 ', '2 ']
+    assert summary is not None
@@ -0,0 +1,103 @@
+from datetime import timedelta
+
+import pytest
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+import server
+from server import InsertOp, SQLiteStore, UpdateOp, now_local
+
+
+@pytest.fixture
+def orders(tmp_path):
+    collection = SQLiteStore(str(tmp_path / 'store.db'))['orders']
+    collection.create_indexes([
+        IndexModel([('id', 1)], unique=True),
+        IndexModel([('createdAt', 1)]),
+        IndexModel([('status', 1), ('createdAt', 1)]),
+    ])
+    return collection
+
+
+def add(collection, *docs):
+    for doc in docs:
+        collection.insert_one({'_id': doc['id'], **doc})
+
+
+def ids(docs):
+    return [doc['_id'] for doc in docs]
+
+
+def test_roundtrip_keeps_types(orders):
+    at = now_local()
+    add(orders, {'id': 1, 'createdAt': at, 'paid': True, 'items': [{'name': 'x', 'qty': 2}]})
+    doc = orders.find_one({'id': 1})
+    assert doc['createdAt'] == at
+    assert doc['createdAt'].tzinfo is not None
+    assert doc['paid'] is True
+    assert doc['items'] == [{'name': 'x', 'qty': 2}]
+
+
+def test_duplicate_unique_index(orders):
+    add(orders, {'id': 1})
+    with pytest.raises(DuplicateKeyError):
+        orders.insert_one({'_id': 99, 'id': 1})
+
+
+def test_range_query_does_not_cross_types(orders):
+    # ترتيب MongoDB: أرقام < نصوص - $gt على رقم لا يطابق نصاً
+    add(orders, {'id': 1, 'status': 5}, {'id': 2, 'status': 'new'}, {'id': 3, 'status': 10})
+    assert ids(orders.find({'status': {'$gt': 5}})) == [3]
+    assert ids(orders.find({'status': {'$gte': 'a'}})) == [2]
+
+
+def test_sort_limit_and_projection(orders):
+    base = now_local()
+    add(orders, *({'id': i, 'createdAt': base + timedelta(minutes=i), 'total': i * 10} for i in range(1, 6)))
+    docs = list(orders.find({'createdAt': {'$gte': base + timedelta(minutes=2)}}, projection={'total': 1})
+                .sort('createdAt', -1).limit(2))
+    assert docs == [{'_id': 5, 'total': 50}, {'_id': 4, 'total': 40}]
+
+
+def test_unindexed_filter_is_rechecked(orders):
+    add(orders, {'id': 1, 'note': 'a'}, {'id': 2, 'note': 'b'})
+    assert ids(orders.find({'note': 'b'})) == [2]
+    assert orders.count_documents({'note': {'$in': ['a', 'b']}}) == 2
+
+
+def test_update_upsert_and_return_document(orders):
+    orders.update_one({'_id': 'c'}, {'$inc': {'n': 1}}, upsert=True)
+    after = orders.find_one_and_update({'_id': 'c'}, {'$inc': {'n': 1}, '$set': {'status': 'ready'}},
+                                       return_document=ReturnDocument.AFTER)
+    assert after == {'_id': 'c', 'n': 2, 'status': 'ready'}
+    assert orders.count_documents({'status': 'ready'}) == 1
+
+
+def test_bulk_write_reports_duplicates_and_keeps_the_rest(orders):
+    add(orders, {'id': 1})
+    with pytest.raises(BulkWriteError) as info:
+        orders.bulk_write([InsertOp({'_id': 1, 'id': 1}), InsertOp({'_id': 2, 'id': 2}),
+                           UpdateOp({'_id': 2}, {'$set': {'status': 'new'}})], ordered=False)
+    assert [err['code'] for err in info.value.details['writeErrors']] == [11000]
+    assert orders.find_one({'_id': 2})['status'] == 'new'
+
+
+def test_aggregate_stats_pipelines(orders):
+    today = server.local_midnight()
+    add(orders,
+        {'id': 1, 'status': 'delivered', 'total': 30, 'createdAt': today + timedelta(hours=1)},
+        {'id': 2, 'status': 'new', 'total': 20, 'createdAt': today + timedelta(hours=2)},
+        {'id': 3, 'status': 'delivered', 'total': 50, 'createdAt': today - timedelta(hours=1)})
+    pipelines = server.stats_pipelines(today)
+    by_status = {g['_id']: g['count'] for g in orders.aggregate(pipelines['byStatus'])}
+    assert by_status == {'delivered': 2, 'new': 1}
+    assert list(orders.aggregate(pipelines['today'])) == [{'_id': None, 'count': 2, 'revenue': 30}]
+
+
+def test_ttl_sweep_runs_on_bulk_write(tmp_path):
+    events = SQLiteStore(str(tmp_path / 'ttl.db'))['order_events']
+    events.create_indexes([IndexModel([('at', 1)], expireAfterSeconds=60)])
+    events.insert_one({'_id': 1, 'at': now_local() - timedelta(minutes=5)})
+    events._swept_at = -server.SQLITE_TTL_SWEEP_SECONDS   # آخر تنظيف قبل دقيقة
+    events.bulk_write([InsertOp({'_id': 2, 'at': now_local()})])
+    assert ids(events.find({})) == [2]